@@ -34,6 +34,7 @@ import logging
 import os
 import subprocess
 
+from .data_utils.embeddings import VECTORS_DTYPE_CHOICES, VECTORS_DTYPE_HELP, VECTORS_ON_DEVICE_HELP
 from .tasks.registry import get_tasks
 from .util import have_multilingual
 
@@ -58,6 +59,8 @@ def parse_argv(parser):
     parser.add_argument('--data', default='.data/', type=str, help='where to load data from.')
     parser.add_argument('--save', required=True, type=str, help='where to save results.')
     parser.add_argument('--embeddings', default='.embeddings', type=str, help='where to save embeddings.')
+    parser.add_argument('--vectors_dtype', default='float32', choices=VECTORS_DTYPE_CHOICES, help=VECTORS_DTYPE_HELP)
+    parser.add_argument('--vectors_on_device', action='store_true', help=VECTORS_ON_DEVICE_HELP)
     parser.add_argument('--cache', default='.cache/', type=str, help='where to save cached files')
 
     parser.add_argument('--train_languages', type=str,
@@ -227,6 +230,9 @@ def parse_argv(parser):
                         help='whether to use exisiting cached splits or generate new ones')
     parser.add_argument('--cache_input_data', action='store_true',
                         help='Cache examples from input data for faster subsequent trainings')
+    parser.add_argument('--numericalized_cache', action='store_true',
+                        help='Cache the token ids of the preprocessed examples as memory-mapped arrays, '
+                             'so they are not looked up again for every batch or every run')
     parser.add_argument('--use_curriculum', action='store_true', help='Use curriculum learning')
     parser.add_argument('--aux_dataset', default='', type=str,
                         help='path to auxiliary dataset (ignored if curriculum is not used)')
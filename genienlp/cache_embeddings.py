@@ -31,7 +31,7 @@
 import logging
 from pprint import pformat
 
-from .data_utils.embeddings import load_embeddings
+from .data_utils.embeddings import load_embeddings, VECTORS_DTYPE_CHOICES, VECTORS_DTYPE_HELP
 from .util import set_seed
 
 logger = logging.getLogger(__name__)
@@ -41,10 +41,11 @@ def parse_argv(parser):
     parser.add_argument('--seed', default=123, type=int, help='Random seed.')
     parser.add_argument('-d', '--destdir', default='.embeddings/', type=str, help='where to save embeddings.')
     parser.add_argument('--embeddings', default='glove+char', help='which embeddings to download')
+    parser.add_argument('--vectors_dtype', default='float32', choices=VECTORS_DTYPE_CHOICES, help=VECTORS_DTYPE_HELP)
 
 
 def main(args):
     logger.info(f'Arguments:\n{pformat(vars(args))}')
 
     set_seed(args)
-    load_embeddings(args.destdir, args.embeddings, '', '', cache_only=True)
+    load_embeddings(args.destdir, args.embeddings, '', '', cache_only=True, vectors_dtype=args.vectors_dtype)
@@ -30,7 +30,6 @@
 
 import torch
 import os
-from collections import defaultdict
 import logging
 from transformers import AutoTokenizer, AutoModel, AutoConfig, \
     BERT_PRETRAINED_MODEL_ARCHIVE_LIST, XLM_ROBERTA_PRETRAINED_MODEL_ARCHIVE_LIST
@@ -39,11 +38,22 @@ from typing import NamedTuple, List
 from .numericalizer.simple import SimpleNumericalizer
 from .numericalizer.transformer import BertNumericalizer, XLMRobertaNumericalizer
 from . import word_vectors
+from .hash_table import HashTable
 from .almond_embeddings import AlmondEmbeddings
 from .pretrained_lstm_lm import PretrainedLTSMLM
 
 _logger = logging.getLogger(__name__)
 
+# subdirectory of an exported model where the vocabulary-restricted word vectors are saved
+VOCAB_EMBEDDINGS_DIR = 'vocab_embeddings'
+
+# choices and help of the --vectors_dtype and --vectors_on_device arguments of the commands that load word vectors
+VECTORS_DTYPE_CHOICES = word_vectors.VECTORS_DTYPES
+VECTORS_DTYPE_HELP = ('how to store and memory-map the cached word vectors; float16 halves their size, '
+                      'int8 (with one scale per vector) quarters it')
+VECTORS_ON_DEVICE_HELP = ('keep a copy of the word vectors of the vocabulary on the same device as the model, instead of '
+                          'looking them up on CPU (use with --vectors_dtype float16 to halve the device memory it takes)')
+
 EMBEDDING_NAME_TO_NUMERICALIZER_MAP = dict()
 EMBEDDING_NAME_TO_NUMERICALIZER_MAP.update({embedding: BertNumericalizer for embedding in BERT_PRETRAINED_MODEL_ARCHIVE_LIST})
 EMBEDDING_NAME_TO_NUMERICALIZER_MAP.update({embedding: XLMRobertaNumericalizer for embedding in XLM_ROBERTA_PRETRAINED_MODEL_ARCHIVE_LIST})
@@ -52,46 +62,141 @@ class EmbeddingOutput(NamedTuple):
     all_layers: List[torch.Tensor]
     last_layer: torch.Tensor
 
+def _ensure_capacity(tensor, num_rows, size, fill_value=0):
+    """Return a tensor with room for at least num_rows rows, that keeps the first size rows of tensor
+
+    When it needs to grow, the capacity at least doubles, so adding rows one at a time costs amortized O(1)
+    copies per row. The rows past size are filled with fill_value.
+    """
+    if num_rows <= tensor.size(0):
+        return tensor
+    capacity = max(num_rows, 2 * tensor.size(0))
+    grown = tensor.new_full((capacity,) + tuple(tensor.shape[1:]), fill_value)
+    grown[:size] = tensor[:size]
+    return grown
+
+
 class WordVectorEmbedding(torch.nn.Module):
-    def __init__(self, vec_collection):
+    def __init__(self, vec_collection, on_device=False):
+        """Arguments:
+               vec_collection: the word vectors to embed the vocabulary with
+               on_device: keep a copy of the vocabulary embedding on the device of the input, so looking
+                   up words does not go through the CPU; otherwise, the embedding stays on CPU only
+        """
         super().__init__()
         self._vec_collection = vec_collection
         self.dim = vec_collection.dim
         self.num_layers = 0
         self.embedding = None
+        # per-row scales if the vectors are stored as int8, None otherwise
+        self.scales = None
+        # number of rows of the embedding that are in use; the rest is slack to grow the vocabulary into
+        self.num_rows = 0
+
+        self.on_device = on_device
+        # copy of the embedding weight and scales on the device, created at the first forward pass
+        self._device_weight = None
+        self._device_scales = None
+        # pinned memory buffer used to copy the result of the lookup on CPU to the device without blocking,
+        # and the event that marks the end of the last copy out of it
+        self._staging_buffer = None
+        self._staging_event = None
+
+    def _quantize(self, vectors):
+        # store the vectors for the vocabulary with the same dtype as the word vector cache
+        values, scales = word_vectors.quantize_vectors(vectors.numpy(), getattr(self._vec_collection, 'dtype', 'float32'))
+        return torch.from_numpy(values), (torch.from_numpy(scales) if scales is not None else None)
 
     def init_for_vocab(self, vocab):
-        vectors = torch.empty(len(vocab), self.dim, device=torch.device('cpu'))
-        for ti, token in enumerate(vocab.itos):
-            vectors[ti] = self._vec_collection[token.strip()]
+        vectors, self.scales = self._quantize(
+            self._vec_collection.lookup_many([token.strip() for token in vocab.itos]))
 
         # wrap in a list so it will not be saved by torch.save and it will not
         # be moved around by .to() and similar methods
         self.embedding = [torch.nn.Embedding(len(vocab.itos), self.dim)]
-        self.embedding[0].weight.data = vectors
+        self.embedding[0].weight = torch.nn.Parameter(vectors, requires_grad=False)
+        self.num_rows = len(vocab.itos)
+        self._device_weight = None
+        self._device_scales = None
 
     def grow_for_vocab(self, vocab, new_words):
         if not new_words:
             return
-        new_vectors = []
-        for word in new_words:
-            new_vector = self._vec_collection[word]
-
-            # charNgram returns  a [1, D] tensor, while Glove returns a [D] tensor
-            # normalize to [1, D] so we can concat along the second dimension
-            # and later concat all vectors along the first
-            new_vector = new_vector if new_vector.dim() > 1 else new_vector.unsqueeze(0)
-            new_vectors.append(new_vector)
-
-        if new_vectors:
-            self.embedding[0].weight.data = torch.cat([self.embedding[0].weight.data.cpu()] + new_vectors, dim=0)
+        new_vectors, new_scales = self._quantize(self._vec_collection.lookup_many(new_words))
+
+        # new words normally get new ids at the end of the vocabulary, but if the number of
+        # out-of-vocabulary words is bounded, they can also reuse the id of an evicted word,
+        # in which case we overwrite the row in place
+        new_ids = torch.tensor([vocab.stoi[word] for word in new_words], dtype=torch.int64)
+        old_num_rows = self.num_rows
+        num_rows = max(self.num_rows, int(new_ids.max()) + 1)
+        weight = self.embedding[0].weight.data
+        if num_rows > weight.size(0):
+            weight = _ensure_capacity(weight, num_rows, self.num_rows)
+            self.embedding[0].weight = torch.nn.Parameter(weight, requires_grad=False)
+            if self.scales is not None:
+                self.scales = _ensure_capacity(self.scales, num_rows, self.num_rows, fill_value=1)
+        self.num_rows = num_rows
+
+        weight[new_ids] = new_vectors
+        if self.scales is not None:
+            self.scales[new_ids] = new_scales
+
+        # apply the same update to the copy on the device, rather than copying the whole embedding again
+        if self._device_weight is not None:
+            device = self._device_weight.device
+            device_ids = new_ids.to(device)
+            self._device_weight = _ensure_capacity(self._device_weight, num_rows, old_num_rows)
+            self._device_weight[device_ids] = new_vectors.to(device)
+            if self._device_scales is not None:
+                self._device_scales = _ensure_capacity(self._device_scales, num_rows, old_num_rows, fill_value=1)
+                self._device_scales[device_ids] = new_scales.to(device)
+
+    def _to_device(self, device):
+        if self._device_weight is None or self._device_weight.device != device:
+            self._device_weight = self.embedding[0].weight.data[:self.num_rows].to(device)
+            self._device_scales = self.scales[:self.num_rows].to(device) if self.scales is not None else None
+        return self._device_weight, self._device_scales
+
+    def _stage(self, rows, device):
+        # copy the rows into a reusable pinned buffer, from which they can be copied to the device asynchronously
+        num_elements = rows.numel()
+        if self._staging_buffer is None or self._staging_buffer.numel() < num_elements:
+            self._staging_buffer = torch.empty(max(num_elements, 2 * self._staging_buffer.numel())
+                                               if self._staging_buffer is not None else num_elements).pin_memory()
+            self._staging_event = None
+        elif self._staging_event is not None:
+            # wait until the previous copy out of the buffer is done before overwriting it
+            self._staging_event.synchronize()
+        staged = self._staging_buffer[:num_elements].view(rows.shape)
+        staged.copy_(rows)
+        on_device = staged.to(device, non_blocking=True)
+        self._staging_event = torch.cuda.Event()
+        self._staging_event.record(torch.cuda.current_stream(device))
+        return on_device
 
     def forward(self, input: torch.Tensor, padding=None):
-        last_layer = self.embedding[0](input.cpu()).to(input.device)
+        if self.on_device and input.device.type != 'cpu':
+            weight, scales = self._to_device(input.device)
+            indices = input
+        else:
+            weight, scales = self.embedding[0].weight, self.scales
+            indices = input.cpu()
+
+        # dequantize only the rows we look up
+        last_layer = torch.nn.functional.embedding(indices, weight).to(dtype=torch.float32)
+        if scales is not None:
+            last_layer *= scales[indices].unsqueeze(-1)
+        if last_layer.device != input.device:
+            if input.device.type == 'cuda':
+                last_layer = self._stage(last_layer, input.device)
+            else:
+                last_layer = last_layer.to(input.device)
         return EmbeddingOutput(all_layers=[last_layer], last_layer=last_layer)
 
     def to(self, *args, **kwargs):
         # ignore attempts to move the word embedding, which should stay on CPU
+        # (with on_device, forward keeps a copy on the device of the input)
         kwargs['device'] = torch.device('cpu')
         return super().to(*args, **kwargs)
 
@@ -125,13 +230,13 @@ class PretrainedLMEmbedding(torch.nn.Module):
         pretrained_save_dict = torch.load(os.path.join(cachedir, model_name), map_location=torch.device('cpu'))
 
         self.itos = pretrained_save_dict['vocab']
-        self.stoi = defaultdict(lambda: 0, {
-            w: i for i, w in enumerate(self.pretrained_decoder_vocab_itos)
-        })
+        self.stoi = HashTable(self.itos)
+        # words that are not in the pretrained vocabulary are mapped to <unk>, or to the first word if there is no <unk>
+        self.unk_id = self.stoi.get('<unk>', 0)
         self.dim = pretrained_save_dict['settings']['nhid']
         self.num_layers = 1
         self.model = PretrainedLTSMLM(rnn_type=pretrained_save_dict['settings']['rnn_type'],
-                                      ntoken=len(self.pretrained_decoder_vocab_itos),
+                                      ntoken=len(self.itos),
                                       emsize=pretrained_save_dict['settings']['emsize'],
                                       nhid=pretrained_save_dict['settings']['nhid'],
                                       nlayers=pretrained_save_dict['settings']['nlayers'],
@@ -139,37 +244,74 @@ class PretrainedLMEmbedding(torch.nn.Module):
         self.model.load_state_dict(pretrained_save_dict['model'], strict=True)
 
         self.vocab_to_pretrained = None
+        # number of entries of vocab_to_pretrained that are in use; the rest is slack to grow the vocabulary into
+        self.num_rows = 0
 
-    def init_for_vocab(self, vocab):
-        self.vocab_to_pretrained = torch.empty(len(self.vocab), dtype=torch.int64)
+    def _to_pretrained(self, words):
+        pretrained_ids = self.stoi.get_many(words)
+        pretrained_ids[pretrained_ids < 0] = self.unk_id
+        return torch.from_numpy(pretrained_ids)
 
-        unk_id = self.stoi['<unk>']
-        for ti, token in enumerate(vocab.itos):
-            if token in self.pretrained_decoder_vocab_stoi:
-                self.vocab_to_pretrained[ti] = self.stoi[token]
-            else:
-                self.vocab_to_pretrained[ti] = unk_id
+    def init_for_vocab(self, vocab):
+        self.vocab_to_pretrained = self._to_pretrained(vocab.itos)
+        self.num_rows = len(vocab.itos)
 
     def grow_for_vocab(self, vocab, new_words):
-        self.init_for_vocab(vocab)
+        if not new_words:
+            return
+
+        # map only the new words, and keep the mapping of the rest of the vocabulary
+        new_ids = torch.tensor([vocab.stoi[word] for word in new_words], dtype=torch.int64)
+        num_rows = max(self.num_rows, int(new_ids.max()) + 1)
+        self.vocab_to_pretrained = _ensure_capacity(self.vocab_to_pretrained, num_rows, self.num_rows,
+                                                    fill_value=self.unk_id)
+        self.num_rows = num_rows
+        self.vocab_to_pretrained[new_ids] = self._to_pretrained(new_words)
 
     def forward(self, input: torch.Tensor, padding=None):
-        pretrained_indices = torch.gather(self.vocab_to_pretrained, dim=0, index=input)
-        rnn_output = self.model(pretrained_indices)
+        # the mapping stays on CPU, like the word vector embeddings
+        pretrained_indices = self.vocab_to_pretrained[input.cpu()].to(input.device)
+        # the language model is sequence-first, and its hidden states are the embedding
+        rnn_output, _hidden = self.model.encode(pretrained_indices.t())
+        rnn_output = rnn_output.transpose(0, 1)
         return EmbeddingOutput(all_layers=[rnn_output], last_layer=rnn_output)
 
-def _name_to_vector(emb_name, cachedir):
+def _vocab_vectors_name(emb_name):
+    return emb_name.replace('/', '_') + '.txt'
+
+
+def _name_to_vector(emb_name, cachedir, vocab_embeddings_dir=None, vocab_embeddings_fallback=True,
+                    vectors_dtype='float32', vectors_on_device=False):
+    vocab_vectors_dtype = None
+    if vocab_embeddings_dir:
+        # the vocabulary vectors are loaded with the dtype they were exported with, whatever vectors_dtype is,
+        # because lookups dequantize them to float32 anyway
+        vocab_vectors_dtype = word_vectors.find_vectors_cache_dtype(
+            os.path.join(vocab_embeddings_dir, _vocab_vectors_name(emb_name)), vectors_dtype)
+    if vocab_vectors_dtype is not None:
+        if vocab_embeddings_fallback:
+            def load_fallback():
+                return _name_to_vector(emb_name, cachedir, vectors_dtype=vectors_dtype)._vec_collection
+        else:
+            load_fallback = None
+        return WordVectorEmbedding(word_vectors.VocabVectors(_vocab_vectors_name(emb_name), vocab_embeddings_dir,
+                                                             load_fallback=load_fallback, dtype=vocab_vectors_dtype),
+                                   on_device=vectors_on_device)
+
     if emb_name == 'glove':
-        return WordVectorEmbedding(word_vectors.GloVe(cache=cachedir))
+        return WordVectorEmbedding(word_vectors.GloVe(cache=cachedir, dtype=vectors_dtype), on_device=vectors_on_device)
     elif emb_name == 'small_glove':
-        return WordVectorEmbedding(word_vectors.GloVe(cache=cachedir, name="6B", dim=50))
+        return WordVectorEmbedding(word_vectors.GloVe(cache=cachedir, name="6B", dim=50, dtype=vectors_dtype),
+                                   on_device=vectors_on_device)
     elif emb_name == 'char':
-        return WordVectorEmbedding(word_vectors.CharNGram(cache=cachedir))
+        return WordVectorEmbedding(word_vectors.CharNGram(cache=cachedir, dtype=vectors_dtype), on_device=vectors_on_device)
     elif emb_name == 'almond_type':
         return AlmondEmbeddings()
     elif emb_name.startswith('fasttext/'):
         # FIXME this should use the fasttext library
-        return WordVectorEmbedding(word_vectors.FastText(cache=cachedir, language=emb_name[len('fasttext/'):]))
+        return WordVectorEmbedding(word_vectors.FastText(cache=cachedir, language=emb_name[len('fasttext/'):],
+                                                         dtype=vectors_dtype),
+                                   on_device=vectors_on_device)
     elif emb_name.startswith('pretrained_lstm/'):
         return PretrainedLMEmbedding(emb_name[len('pretrained_lstm/'):], cachedir=cachedir)
     else:
@@ -180,10 +322,32 @@ def get_embedding_type(emb_name):
         return emb_name.split('@')[0]
     else:
         return emb_name
-    
+
+
+def save_vocab_embeddings(savedir, cachedir, emb_names, vocab, vectors_dtype='float32'):
+    """Save the rows of the word vector embeddings in emb_names that match the vocabulary, in vocabulary order
+
+    The result is saved in the VOCAB_EMBEDDINGS_DIR subdirectory of savedir, and can be used with
+    the vocab_embeddings_dir argument of load_embeddings instead of the full embedding tables.
+    """
+    tokens = list(dict.fromkeys(token.strip() for token in vocab.itos))
+    vocab_embeddings_dir = os.path.join(savedir, VOCAB_EMBEDDINGS_DIR)
+    for emb_type in dict.fromkeys(get_embedding_type(emb_name) for emb_name in emb_names if emb_name):
+        if emb_type in EMBEDDING_NAME_TO_NUMERICALIZER_MAP:
+            continue
+        # only the rows of the vocabulary are quantized (by save_vectors), not the whole table in the shared cache
+        vec = _name_to_vector(emb_type, cachedir)
+        if not isinstance(vec, WordVectorEmbedding):
+            continue
+        os.makedirs(vocab_embeddings_dir, exist_ok=True)
+        word_vectors.save_vectors(os.path.join(vocab_embeddings_dir, _vocab_vectors_name(emb_type)),
+                                  tokens, vec._vec_collection.lookup_many(tokens), dtype=vectors_dtype)
+
 
 def load_embeddings(cachedir, context_emb_names, question_emb_names, decoder_emb_names,
-                    max_generative_vocab=50000, logger=_logger, cache_only=False):
+                    max_generative_vocab=50000, logger=_logger, cache_only=False,
+                    vocab_embeddings_dir=None, vocab_embeddings_fallback=True, vectors_dtype='float32',
+                    vectors_on_device=False):
     logger.info(f'Getting pretrained word vectors and pretrained models')
 
     context_emb_names = context_emb_names.split('+')
@@ -225,7 +389,8 @@ def load_embeddings(cachedir, context_emb_names, question_emb_names, decoder_emb
         else:
             if numericalizer is not None:
                 logger.warning('Combining Transformer embeddings with other pretrained embeddings is unlikely to work')
-            vec = _name_to_vector(emb_type, cachedir)
+            vec = _name_to_vector(emb_type, cachedir, vocab_embeddings_dir, vocab_embeddings_fallback, vectors_dtype,
+                                  vectors_on_device)
             all_vectors[emb_name] = vec
             context_vectors.append(vec)
 
@@ -258,7 +423,8 @@ def load_embeddings(cachedir, context_emb_names, question_emb_names, decoder_emb
         else:
             if numericalizer is not None:
                 logger.warning('Combining Transformer embeddings with other pretrained embeddings is unlikely to work')
-            vec = _name_to_vector(emb_type, cachedir)
+            vec = _name_to_vector(emb_type, cachedir, vocab_embeddings_dir, vocab_embeddings_fallback, vectors_dtype,
+                                  vectors_on_device)
             all_vectors[emb_name] = vec
             question_vectors.append(vec)
 
@@ -272,7 +438,8 @@ def load_embeddings(cachedir, context_emb_names, question_emb_names, decoder_emb
         if emb_name in all_vectors:
             decoder_vectors.append(all_vectors[emb_name])
         else:
-            vec = _name_to_vector(emb_type, cachedir)
+            vec = _name_to_vector(emb_type, cachedir, vocab_embeddings_dir, vocab_embeddings_fallback, vectors_dtype,
+                                  vectors_on_device)
             all_vectors[emb_name] = vec
             decoder_vectors.append(vec)
 
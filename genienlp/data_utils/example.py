@@ -27,13 +27,77 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from typing import NamedTuple, List
+from typing import NamedTuple, List, Any
 import itertools
 import random
+import numpy as np
 
 from .numericalizer.sequential_field import SequentialField
 
 
+class TokenIds(NamedTuple):
+    """The ids of a TokenList, as computed by a numericalizer for a specific vocabulary and decoder vocabulary"""
+    vocab_version: Any
+    decoder_stoi: Any
+    ids: np.ndarray
+    limited: np.ndarray
+    oov_positions: np.ndarray
+    oov_words: List[str]
+
+
+class TokenList(list):
+    """A list of tokens, on which a numericalizer can cache the ids it computed for them
+
+    The cached ids are not pickled, because they are only valid for the vocabulary they were computed with.
+    Slicing a TokenList returns a TokenList with the matching slice of the cached ids, so that truncating
+    a sentence does not require computing them again.
+    """
+    __slots__ = ('ids',)
+
+    def __init__(self, tokens=()):
+        super().__init__(tokens)
+        self.ids = None
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return super().__getitem__(index)
+        tokens = TokenList(super().__getitem__(index))
+        if self.ids is not None:
+            limited = self.ids.limited[index]
+            oov_positions = np.flatnonzero(limited < 0)
+            tokens.ids = self.ids._replace(ids=self.ids.ids[index], limited=limited, oov_positions=oov_positions,
+                                           oov_words=[tokens[position] for position in oov_positions])
+        return tokens
+
+    def __reduce__(self):
+        return TokenList, (list(self),)
+
+
+class TokenIdList(object):
+    """A read-only list of tokens stored only as their ids in a vocabulary (e.g. loaded from a numericalized cache)
+
+    The tokens are looked up in the vocabulary when they are accessed, so the vocabulary must only grow while
+    the list is in use. Like on a TokenList, a numericalizer can cache the ids it computed for them.
+    """
+    __slots__ = ('vocab_ids', 'itos', 'ids')
+
+    def __init__(self, vocab_ids, itos):
+        self.vocab_ids = vocab_ids
+        self.itos = itos
+        self.ids = None
+
+    def __len__(self):
+        return len(self.vocab_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.itos[word_id] for word_id in self.vocab_ids[index]]
+        return self.itos[self.vocab_ids[index]]
+
+    def __iter__(self):
+        return (self.itos[word_id] for word_id in self.vocab_ids)
+
+
 class Example(NamedTuple):
     example_id: str
     # for each field in the example, we store the tokenized sentence, and a boolean mask
@@ -61,7 +125,7 @@ class Example(NamedTuple):
                 mask = [True for _ in words]
             if lower:
                 words = [word.lower() for word in words]
-            args.append(words)
+            args.append(TokenList(words))
             args.append(mask)
         
         return Example(*args)
@@ -28,7 +28,11 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import numpy as np
-from tqdm import tqdm
+
+
+STRING_HASH_P = 1009
+# number of strings hashed or looked up at a time, to bound the size of the temporary 'U' arrays
+HASH_BLOCK_SIZE = 65536
 
 
 def string_hash(x):
@@ -39,7 +43,7 @@ def string_hash(x):
     and it uses 8 bytes (which is too much for our uses)
     """
 
-    P = 1009
+    P = STRING_HASH_P
     h = 0
     for c in x:
         h = (h << 10) + h + ord(c) * P
@@ -47,22 +51,139 @@ def string_hash(x):
     return np.uint32(h)
 
 
+def string_hash_array(strings):
+    """ Vectorized version of string_hash, over a NumPy array of strings
+
+    The strings are viewed as a fixed-width array of code points, and all of them are
+    hashed at once, one character position at a time.
+    Returns the hashes as an array of np.uint64 (with values that fit in 32 bits).
+    """
+    strings = np.ascontiguousarray(strings)
+    if strings.dtype.kind != 'U':
+        strings = strings.astype(str)
+    num_strings = strings.shape[0]
+    max_str_len = strings.dtype.itemsize // 4
+
+    lengths = np.char.str_len(strings)
+    code_points = strings.view(np.uint32).reshape(num_strings, max_str_len)
+
+    P = np.uint64(STRING_HASH_P)
+    h = np.zeros((num_strings,), dtype=np.uint64)
+    for position in range(max_str_len):
+        active = lengths > position
+        if not active.any():
+            break
+        new_h = ((h << np.uint64(10)) + h + code_points[:, position].astype(np.uint64) * P) & np.uint64(0xFFFFFFFF)
+        h = np.where(active, new_h, h)
+    return h
+
+
+# maximum number of characters (number of strings times the longest length) in a block
+HASH_BLOCK_CHARS = HASH_BLOCK_SIZE * 32
+
+
+def length_sorted_blocks(strings):
+    """ Split the indices of a list of strings into blocks of strings of similar length
+
+    A 'U' array is as wide as its longest string, so grouping strings by length keeps a single long string
+    from making the arrays of all the others as wide as itself. Each block has at most HASH_BLOCK_SIZE
+    strings, and at most HASH_BLOCK_CHARS characters once padded to the longest string.
+    """
+    lengths = np.array([len(x) for x in strings], dtype=np.int64)
+    order = np.argsort(lengths, kind='stable')
+    sorted_lengths = lengths[order]
+
+    blocks = []
+    start = 0
+    while start < order.shape[0]:
+        candidate_lengths = sorted_lengths[start:start + HASH_BLOCK_SIZE]
+        padded_sizes = np.arange(1, candidate_lengths.shape[0] + 1) * candidate_lengths
+        end = start + max(1, int(np.searchsorted(padded_sizes, HASH_BLOCK_CHARS, side='right')))
+        blocks.append(order[start:end])
+        start = end
+    return blocks
+
+
+class StringArray(object):
+    """ A read-only array of strings, stored as a blob of UTF-8 bytes and the offset of each string in it
+
+    Unlike a NumPy 'U' array, which uses 4 bytes per character for the longest string, each string only
+    takes the length of its UTF-8 encoding. Both arrays can be saved and memory-mapped.
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @staticmethod
+    def from_strings(strings):
+        encoded = [x.encode('utf-8') for x in strings]
+        offsets = np.zeros((len(encoded) + 1,), dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return StringArray(offsets, blob)
+
+    @staticmethod
+    def load(path, mmap_mode=None):
+        return StringArray(np.load(path + '.offsets.npy', mmap_mode=mmap_mode),
+                           np.load(path + '.blob.npy', mmap_mode=mmap_mode))
+
+    def save(self, path):
+        np.save(path + '.offsets.npy', self.offsets)
+        np.save(path + '.blob.npy', self.blob)
+
+    @property
+    def shape(self):
+        return (self.offsets.shape[0] - 1,)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, index):
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def equals(self, indices, keys):
+        """ Compare the strings at the given indices with an array of keys, one by one
+
+        Returns an array of np.bool_.
+        """
+        keys = np.char.encode(np.asarray(keys, dtype=str), 'utf-8')
+        starts = np.asarray(self.offsets[indices], dtype=np.int64)
+        lengths = np.asarray(self.offsets[indices + 1], dtype=np.int64) - starts
+        result = lengths == np.char.str_len(keys)
+
+        # compare the bytes of all the candidates with the same length at once
+        candidates = np.flatnonzero(result & (lengths > 0))
+        if candidates.shape[0] > 0:
+            width = keys.dtype.itemsize
+            key_bytes = np.ascontiguousarray(keys[candidates]).view(np.uint8).reshape(candidates.shape[0], width)
+            positions = starts[candidates, np.newaxis] + np.arange(width)
+            valid = np.arange(width) < lengths[candidates, np.newaxis]
+            stored_bytes = np.where(valid, self.blob[np.where(valid, positions, 0)], 0)
+            result[candidates] = (stored_bytes == key_bytes).all(axis=1)
+        return result
+
+
 class HashTable(object):
     EMPTY_BUCKET = 0
 
     def __init__(self, itos, table=None):
         # open addressing hashing, with load factor 0.50
+        self._max_length_cache = None
 
         if table is not None:
-            assert isinstance(itos, np.ndarray)
+            # itos is either a StringArray, or a 'U' array from caches saved by older versions
+            assert isinstance(itos, (StringArray, np.ndarray))
 
             self.itos = itos
             self.table = table
             self.table_size = table.shape[0]
         else:
-
-            max_str_len = max(len(x) for x in itos)
-            self.itos = np.array(itos, dtype='U' + str(max_str_len))
+            self.itos = StringArray.from_strings(itos)
 
             self.table_size = int(len(itos) * 2)
             self.table = np.zeros((self.table_size,), dtype=np.int64)
@@ -70,16 +191,35 @@ class HashTable(object):
             self._build(itos)
 
     def _build(self, itos):
-        for i, word in enumerate(tqdm(itos, total=len(itos))):
-            hash = string_hash(word)
-            bucket = hash % self.table_size
+        # insert all words at once, in rounds: at each round, every word that is not yet
+        # in the table probes the next bucket in its sequence, and the lowest index wins
+        # each empty bucket
+        # every word ends up in a bucket such that all the buckets before it in its probe
+        # sequence are full, so _find (and tables built by inserting one word at a time)
+        # work exactly as before
+        itos = list(itos)
+        hashes = np.zeros((len(itos),), dtype=np.uint64)
+        for block in length_sorted_blocks(itos):
+            hashes[block] = string_hash_array(np.array([itos[i] for i in block], dtype=str))
+        table_size = np.uint64(self.table_size)
 
-            while self.table[bucket] != self.EMPTY_BUCKET:
-                hash += 7
-                bucket = hash % self.table_size
+        remaining = np.arange(self.itos.shape[0], dtype=np.int64)
+        probe_count = 0
+        while remaining.shape[0] > 0:
+            probe_hashes = (hashes[remaining] + np.uint64(7 * probe_count)) & np.uint64(0xFFFFFFFF)
+            buckets = (probe_hashes % table_size).astype(np.int64)
 
-            self.itos[i] = word
-            self.table[bucket] = 1 + i
+            empty = self.table[buckets] == self.EMPTY_BUCKET
+            # np.unique returns the first occurrence of each bucket, which is the lowest index because
+            # remaining is sorted
+            winning_buckets, first_occurrence = np.unique(buckets[empty], return_index=True)
+            winners = remaining[empty][first_occurrence]
+            self.table[winning_buckets] = 1 + winners
+
+            inserted = np.zeros((remaining.shape[0],), dtype=np.bool_)
+            inserted[np.flatnonzero(empty)[first_occurrence]] = True
+            remaining = remaining[~inserted]
+            probe_count += 1
 
     def __iter__(self):
         return iter(self.itos)
@@ -88,7 +228,7 @@ class HashTable(object):
         return reversed(self.itos)
 
     def __len__(self):
-        return self.itos
+        return len(self.itos)
 
     def __eq__(self, other):
         return isinstance(other, HashTable) and self.itos == other.itos
@@ -126,3 +266,56 @@ class HashTable(object):
             return default
         else:
             return found
+
+    def get_many(self, keys):
+        """ Look up many keys at once
+
+        Returns an array of np.int64 with the index of each key, or -1 for keys that are not in the table.
+        """
+        keys = list(keys)
+        result = np.full((len(keys),), -1, dtype=np.int64)
+
+        # a key with more characters than the longest string (in bytes) cannot be in the table
+        max_length = self._max_length()
+        for block in length_sorted_blocks(keys):
+            block = block[np.array([len(keys[i]) for i in block], dtype=np.int64) <= max_length]
+            if block.shape[0] > 0:
+                result[block] = self._get_many_block(np.array([keys[i] for i in block], dtype=str))
+        return result
+
+    def _max_length(self):
+        if getattr(self, '_max_length_cache', None) is None:
+            if isinstance(self.itos, StringArray):
+                self._max_length_cache = int(np.max(np.diff(self.itos.offsets))) if len(self.itos) > 0 else 0
+            else:
+                self._max_length_cache = self.itos.dtype.itemsize // 4
+        return self._max_length_cache
+
+    def _get_many_block(self, keys):
+        result = np.full((keys.shape[0],), -1, dtype=np.int64)
+
+        hashes = string_hash_array(keys)
+        table_size = np.uint64(self.table_size)
+
+        # probe all keys in lockstep, following the same sequence as _find
+        remaining = np.arange(keys.shape[0], dtype=np.int64)
+        for probe_count in range(self.table_size):
+            probe_hashes = (hashes[remaining] + np.uint64(7 * probe_count)) & np.uint64(0xFFFFFFFF)
+            buckets = (probe_hashes % table_size).astype(np.int64)
+            key_indices = np.asarray(self.table[buckets], dtype=np.int64)
+
+            not_empty = key_indices != self.EMPTY_BUCKET
+            remaining = remaining[not_empty]
+            key_indices = key_indices[not_empty]
+            if remaining.shape[0] == 0:
+                break
+
+            if isinstance(self.itos, StringArray):
+                found = self.itos.equals(key_indices - 1, keys[remaining])
+            else:
+                found = np.asarray(self.itos[key_indices - 1]) == keys[remaining]
+            result[remaining[found]] = key_indices[found] - 1
+            remaining = remaining[~found]
+            if remaining.shape[0] == 0:
+                break
+        return result
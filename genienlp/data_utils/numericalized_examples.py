@@ -0,0 +1,242 @@
+#
+# Copyright (c) 2019-2020 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import logging
+import os
+import pickle
+import re
+import shutil
+import uuid
+import numpy as np
+
+from .example import Example, TokenIdList
+from .hash_table import StringArray
+
+logger = logging.getLogger(__name__)
+
+
+def data_files(data_dir, exclude_dirs=()):
+    """
+    List the files in data_dir with their size and modification time, without reading them.
+
+    Returns a sorted list of (relative path, size, modification time in ns) tuples.
+    """
+    exclude_dirs = set(os.path.abspath(path) for path in exclude_dirs)
+    files = []
+    for dirpath, dirnames, filenames in os.walk(data_dir, followlinks=True):
+        dirnames[:] = [name for name in dirnames if os.path.abspath(os.path.join(dirpath, name)) not in exclude_dirs]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((os.path.relpath(path, data_dir), stat.st_size, stat.st_mtime_ns))
+    files.sort()
+    return files
+
+
+class NumericalizedExamples(object):
+    """
+    The example ids and token ids of a list of examples, stored as flat arrays with offsets.
+
+    For each field, `ids` holds the ids of the tokens in the vocabulary, and `limited` holds their ids in
+    the decoder vocabulary, or -1 for tokens outside of it (those get an id that depends on the batch);
+    `oov_positions` holds the positions of the latter. The tokens of the i-th example are at offsets[i]:offsets[i+1].
+    """
+
+    fields = ('context', 'question', 'answer', 'context_plus_question')
+    # number of caches to keep in each cache directory; the least recently used ones are removed
+    cache_size = 8
+
+    def __init__(self, example_ids, offsets, ids, limited, oov_positions):
+        self.example_ids = example_ids
+        self.offsets = offsets
+        self.ids = ids
+        self.limited = limited
+        self.oov_positions = oov_positions
+
+    def __len__(self):
+        return len(self.example_ids)
+
+    @staticmethod
+    def cache_key(numericalizer, data_dir, exclude_dirs=(), **options):
+        """
+        Fingerprint the files in data_dir (by path, size and modification time), the options used to load and
+        preprocess them, and the vocabulary they are numericalized with, so that a cache is never used with different
+        data or a different vocabulary, and can be found without loading the data.
+        """
+        h = hashlib.sha1()
+        h.update('\n'.join(numericalizer.vocab.itos).encode('utf-8'))
+        h.update(b'\0')
+        h.update('\n'.join(numericalizer.decoder_vocab.itos).encode('utf-8'))
+        for name, value in sorted(options.items()):
+            h.update(b'\0')
+            h.update(f'{name}={value!r}'.encode('utf-8'))
+        for path, size, mtime in data_files(data_dir, exclude_dirs):
+            h.update(b'\0')
+            h.update(f'{path}\t{size}\t{mtime}'.encode('utf-8'))
+        return h.hexdigest()
+
+    @staticmethod
+    def build(examples, numericalizer):
+        vocab_stoi = numericalizer.vocab.stoi
+        decoder_stoi = numericalizer.decoder_vocab.stoi
+
+        offsets, ids, limited, oov_positions = dict(), dict(), dict(), dict()
+        for field in NumericalizedExamples.fields:
+            lengths = np.array([len(getattr(ex, field)) for ex in examples], dtype=np.int64)
+            offsets[field] = np.zeros((len(examples) + 1,), dtype=np.int64)
+            np.cumsum(lengths, out=offsets[field][1:])
+
+            words = [word for ex in examples for word in getattr(ex, field)]
+            ids[field] = np.array([vocab_stoi[word] for word in words], dtype=np.int32)
+            limited[field] = np.array([decoder_stoi.get(word, -1) for word in words], dtype=np.int32)
+            oov_positions[field] = np.flatnonzero(limited[field] < 0)
+        example_ids = StringArray.from_strings([ex.example_id for ex in examples])
+        return NumericalizedExamples(example_ids, offsets, ids, limited, oov_positions)
+
+    @staticmethod
+    def load(path, mmap_mode=None):
+        offsets, ids, limited, oov_positions = dict(), dict(), dict(), dict()
+        for field in NumericalizedExamples.fields:
+            offsets[field] = np.load(os.path.join(path, field + '.offsets.npy'), mmap_mode=mmap_mode)
+            ids[field] = np.load(os.path.join(path, field + '.ids.npy'), mmap_mode=mmap_mode)
+            limited[field] = np.load(os.path.join(path, field + '.limited.npy'), mmap_mode=mmap_mode)
+            oov_positions[field] = np.load(os.path.join(path, field + '.oov.npy'), mmap_mode=mmap_mode)
+        example_ids = StringArray.load(os.path.join(path, 'example_id'), mmap_mode=mmap_mode)
+        return NumericalizedExamples(example_ids, offsets, ids, limited, oov_positions)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for field in NumericalizedExamples.fields:
+            np.save(os.path.join(path, field + '.offsets.npy'), self.offsets[field])
+            np.save(os.path.join(path, field + '.ids.npy'), self.ids[field])
+            np.save(os.path.join(path, field + '.limited.npy'), self.limited[field])
+            np.save(os.path.join(path, field + '.oov.npy'), self.oov_positions[field])
+        self.example_ids.save(os.path.join(path, 'example_id'))
+
+    @staticmethod
+    def load_cache(path, mmap_mode=None):
+        """
+        Load a cache saved by save_cache.
+
+        Returns the list of NumericalizedExamples (or None) and the metadata.
+        """
+        with open(os.path.join(path, 'metadata.pkl'), 'rb') as handle:
+            metadata = pickle.load(handle)
+        numericalized = [None if missing else NumericalizedExamples.load(os.path.join(path, str(i)), mmap_mode=mmap_mode)
+                         for i, missing in enumerate(metadata['missing'])]
+        return numericalized, metadata
+
+    @staticmethod
+    def save_cache(path, numericalized, metadata):
+        """
+        Save a list of NumericalizedExamples (or None) and a dictionary of metadata in a cache directory.
+        """
+        # write to a temporary directory of our own first, so a partially written cache is never loaded
+        # and concurrent writers never write to the same files
+        tmp_path = '{}.tmp.{}-{}'.format(path, os.getpid(), uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+        try:
+            for i, numericalized_examples in enumerate(numericalized):
+                if numericalized_examples is not None:
+                    numericalized_examples.save(os.path.join(tmp_path, str(i)))
+            metadata = dict(metadata, missing=[numericalized_examples is None for numericalized_examples in numericalized])
+            with open(os.path.join(tmp_path, 'metadata.pkl'), 'wb') as handle:
+                pickle.dump(metadata, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # the path is a hash of the inputs, so a cache saved there meanwhile has the same ids
+                if not os.path.isdir(path):
+                    raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @staticmethod
+    def prune(cache_dir, keep):
+        """
+        Remove all but the `keep` most recently used caches in cache_dir (caches are marked as used by
+        updating the modification time of their directory).
+        """
+        caches = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+                  if re.fullmatch('[0-9a-f]{40}', name) and os.path.isdir(os.path.join(cache_dir, name))]
+        caches.sort(key=os.path.getmtime, reverse=True)
+        for cache_path in caches[keep:]:
+            logger.info(f'Removing unused numericalized cache {cache_path}')
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+    def as_examples(self, numericalizer):
+        """
+        Return a read-only sequence of the examples, backed by the (memory-mapped) arrays.
+
+        The fields of each example are TokenIdLists on which the ids are already cached, so batches are assembled
+        directly from slices of the arrays, and the words are never kept in memory. The word masks are None.
+        """
+        return NumericalizedExampleList(self, numericalizer)
+
+
+class NumericalizedExampleList(object):
+    """The examples of a NumericalizedExamples, created when they are accessed"""
+
+    def __init__(self, numericalized, numericalizer):
+        self.numericalized = numericalized
+        self.numericalizer = numericalizer
+
+    def __len__(self):
+        return len(self.numericalized)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        numericalized = self.numericalized
+        itos = self.numericalizer.vocab.itos
+        fields = dict()
+        for field in NumericalizedExamples.fields:
+            start, end = numericalized.offsets[field][index], numericalized.offsets[field][index + 1]
+            ids = numericalized.ids[field][start:end]
+            oov_positions = numericalized.oov_positions[field]
+            oov_start, oov_end = np.searchsorted(oov_positions, (start, end))
+            tokens = TokenIdList(ids, itos)
+            self.numericalizer.set_token_ids(tokens, ids, numericalized.limited[field][start:end],
+                                             oov_positions[oov_start:oov_end] - start)
+            fields[field] = tokens
+        return Example(numericalized.example_ids[index], fields['context'], None, fields['question'], None,
+                       fields['answer'], None, fields['context_plus_question'], None)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
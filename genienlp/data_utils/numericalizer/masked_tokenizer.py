@@ -42,18 +42,116 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
 from transformers import BertTokenizer, XLMRobertaTokenizer
 from collections import OrderedDict
 
+# words shorter than this are split by searching the vocabulary for shrinking substrings, which is
+# faster than walking the trie for them; longer words are split with the trie
+TRIE_MIN_WORD_LENGTH = 16
+
+class WordPieceCache(object):
+    """
+    A bounded memo of the word-pieces of each word, used by the masked word-piece tokenizers.
+
+    The least recently used words are evicted once max_size words are cached. The memo can be saved
+    next to the tokenizer, so frequent words are not split again when the tokenizer is loaded.
+    """
+
+    file_name = 'word-piece-cache.json'
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._memo = OrderedDict()
+
+    def __len__(self):
+        return len(self._memo)
+
+    def get(self, word):
+        sub_tokens = self._memo.get(word)
+        if sub_tokens is not None:
+            self._memo.move_to_end(word)
+        return sub_tokens
+
+    def put(self, word, sub_tokens):
+        self._memo[word] = tuple(sub_tokens)
+        if len(self._memo) > self.max_size:
+            self._memo.popitem(last=False)
+
+    def load(self, save_dir):
+        path = os.path.join(save_dir, self.file_name)
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as fp:
+            # entries are stored from least to most recently used
+            for word, sub_tokens in json.load(fp):
+                self.put(word, sub_tokens)
+
+    def save(self, save_dir):
+        with open(os.path.join(save_dir, self.file_name), 'w') as fp:
+            json.dump([[word, sub_tokens] for word, sub_tokens in self._memo.items()], fp, ensure_ascii=False)
+
+
+# one more than the largest unicode code point, used to pack a trie node and a character into a single key
+TRIE_CHAR_RANGE = 0x110000
+
+
+class WordPieceTrie(object):
+    """
+    A prefix trie over a set of strings, used to find the longest word-piece at a given position in one pass.
+
+    The transitions of all nodes are stored in a single dict keyed by node * TRIE_CHAR_RANGE + code point,
+    which is much more compact than one dict per node.
+    """
+
+    def __init__(self, words):
+        self._transitions = dict()
+        self._is_word = [False]
+        for word in words:
+            node = 0
+            for char in word:
+                key = node * TRIE_CHAR_RANGE + ord(char)
+                child = self._transitions.get(key)
+                if child is None:
+                    child = len(self._is_word)
+                    self._transitions[key] = child
+                    self._is_word.append(False)
+                node = child
+            self._is_word[node] = True
+
+    def __len__(self):
+        return len(self._is_word)
+
+    def longest_match(self, codes, start):
+        """
+        Return the end of the longest word in the trie that starts at codes[start], or start if there is none.
+
+        codes is the list of code points of the string.
+        """
+        transitions = self._transitions
+        is_word = self._is_word
+        node = 0
+        end = start
+        for i in range(start, len(codes)):
+            node = transitions.get(node * TRIE_CHAR_RANGE + codes[i])
+            if node is None:
+                break
+            if is_word[node]:
+                end = i + 1
+        return end
+
 
 class MaskedXLMRobertaWordPieceTokenizer(object):
-    def __init__(self, vocab, spm, added_tokens_encoder, added_tokens_decoder, unk_token, max_input_chars_per_word=100):
+    def __init__(self, vocab, spm, added_tokens_encoder, added_tokens_decoder, unk_token, max_input_chars_per_word=100,
+                 cache=None):
         self.vocab = vocab
         self.spm = spm
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
         self.added_tokens_encoder = added_tokens_encoder
         self.added_tokens_decoder = added_tokens_decoder
+        self.cache = cache if cache is not None else WordPieceCache()
 
     def tokenize(self, tokens, mask):
         output_tokens = []
@@ -66,24 +164,34 @@ class MaskedXLMRobertaWordPieceTokenizer(object):
                 output_tokens.append(token)
                 continue
 
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
-
-            sub_tokens = self.spm.EncodeAsPieces(token)
+            sub_tokens = self.cache.get(token)
+            if sub_tokens is None:
+                sub_tokens = self._tokenize_word(token)
+                self.cache.put(token, sub_tokens)
             output_tokens.extend(sub_tokens)
 
         return output_tokens
 
+    def _tokenize_word(self, token):
+        if len(token) > self.max_input_chars_per_word:
+            return [self.unk_token]
+
+        return self.spm.EncodeAsPieces(token)
+
 
 class MaskedBertWordPieceTokenizer(object):
-    def __init__(self, vocab, added_tokens_encoder, added_tokens_decoder, unk_token, max_input_chars_per_word=100):
+    def __init__(self, vocab, added_tokens_encoder, added_tokens_decoder, unk_token, max_input_chars_per_word=100,
+                 cache=None):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
         self.added_tokens_encoder = added_tokens_encoder
         self.added_tokens_decoder = added_tokens_decoder
+        self.cache = cache if cache is not None else WordPieceCache()
+
+        # built on first use
+        self._initial_trie = None
+        self._continuation_trie = None
 
     def tokenize(self, tokens, mask):
         output_tokens = []
@@ -98,36 +206,65 @@ class MaskedBertWordPieceTokenizer(object):
                 output_tokens.append(token)
                 continue
 
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
+            sub_tokens = self.cache.get(token)
+            if sub_tokens is None:
+                sub_tokens = self._tokenize_word(token)
+                self.cache.put(token, sub_tokens)
+            output_tokens.extend(sub_tokens)
+        return output_tokens
 
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
+    def _build_tries(self):
+        # the first piece of a word is looked up as is, so it can be any entry of the vocabulary,
+        # while the following pieces are looked up with a ## prefix
+        self._initial_trie = WordPieceTrie(self.vocab)
+        self._continuation_trie = WordPieceTrie(word[2:] for word in self.vocab if word.startswith('##'))
+
+    def _tokenize_word(self, token):
+        if len(token) > self.max_input_chars_per_word:
+            return [self.unk_token]
+        # most words are a single word-piece, which takes one lookup
+        if token in self.vocab:
+            return [token]
+        if len(token) < TRIE_MIN_WORD_LENGTH:
+            return self._search_tokenize_word(token)
+        return self._trie_tokenize_word(token)
+
+    def _search_tokenize_word(self, token):
+        # greedy longest-match-first, probing the vocabulary with every shrinking substring
+        start = 0
+        sub_tokens = []
+        while start < len(token):
+            end = len(token)
+            cur_substr = None
+            while start < end:
+                substr = token[start:end] if start == 0 else '##' + token[start:end]
+                if substr in self.vocab:
+                    cur_substr = substr
                     break
-                sub_tokens.append(cur_substr)
-                start = end
-
-            if is_bad:
-                output_tokens.append(self.unk_token)
-            else:
-                output_tokens.extend(sub_tokens)
-        return output_tokens
+                end -= 1
+            if cur_substr is None:
+                return [self.unk_token]
+            sub_tokens.append(cur_substr)
+            start = end
+        return sub_tokens
+
+    def _trie_tokenize_word(self, token):
+        if self._initial_trie is None:
+            self._build_tries()
+
+        # greedy longest-match-first
+        codes = [ord(char) for char in token]
+        trie = self._initial_trie
+        start = 0
+        sub_tokens = []
+        while start < len(codes):
+            end = trie.longest_match(codes, start)
+            if end == start:
+                return [self.unk_token]
+            sub_tokens.append(token[start:end] if start == 0 else '##' + token[start:end])
+            trie = self._continuation_trie
+            start = end
+        return sub_tokens
 
 
 
@@ -141,11 +278,13 @@ class MaskedXLMRobertaTokenizer(XLMRobertaTokenizer):
         self.ids_to_tokens = OrderedDict((i, vocab) for vocab, i in self.vocab.items())
 
         # replace the word piece tokenizer with ours
+        self.word_piece_cache = WordPieceCache()
         self.wordpiece_tokenizer = MaskedXLMRobertaWordPieceTokenizer(vocab=self.vocab,
                                                                       spm=self.sp_model,
                                                                       added_tokens_encoder=self.added_tokens_encoder,
                                                                       added_tokens_decoder=self.added_tokens_decoder,
-                                                                      unk_token=self.unk_token)
+                                                                      unk_token=self.unk_token,
+                                                                      cache=self.word_piece_cache)
 
         self._itos = IToSWrapper(self.ids_to_tokens, self.added_tokens_decoder)
         self._stoi = SToIWrapper(self.vocab, self.added_tokens_encoder)
@@ -177,10 +316,12 @@ class MaskedBertTokenizer(BertTokenizer):
         super().__init__(*args, do_lower_case=False, do_basic_tokenize=False, **kwargs)
 
         # replace the word piece tokenizer with ours
+        self.word_piece_cache = WordPieceCache()
         self.wordpiece_tokenizer = MaskedBertWordPieceTokenizer(vocab=self.vocab,
                                                             added_tokens_encoder=self.added_tokens_encoder,
                                                             added_tokens_decoder=self.added_tokens_decoder,
-                                                            unk_token=self.unk_token)
+                                                            unk_token=self.unk_token,
+                                                            cache=self.word_piece_cache)
 
         self._itos = IToSWrapper(self.ids_to_tokens, self.added_tokens_decoder)
         self._stoi = SToIWrapper(self.vocab, self.added_tokens_encoder)
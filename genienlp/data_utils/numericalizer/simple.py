@@ -28,11 +28,14 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+from collections import OrderedDict
+import numpy as np
 import torch
 
 from .vocab import Vocab
 from .sequential_field import SequentialField
 from .decoder_vocab import DecoderVocabulary
+from ..example import TokenIds
 
 
 class SimpleNumericalizer(object):
@@ -49,6 +52,12 @@ class SimpleNumericalizer(object):
         self.fix_length = fix_length
         self.pad_first = pad_first
 
+        self.max_oov_words = None
+        self._oov_words = OrderedDict()
+
+        # replaced every time the vocabulary changes, to invalidate the ids cached on the examples
+        self._vocab_version = object()
+
     @property
     def num_tokens(self):
         return len(self.vocab)
@@ -68,6 +77,16 @@ class SimpleNumericalizer(object):
                                            pad_token=self.pad_token)
         self._init_vocab()
 
+    def set_max_oov_words(self, max_oov_words):
+        """
+        Bound the number of out-of-vocabulary words that grow_vocab keeps in the vocabulary.
+
+        Once the limit is reached, each new word replaces the least recently used out-of-vocabulary word
+        and reuses its id, so the vocabulary and the embedding matrices stop growing.
+        """
+        self.max_oov_words = max_oov_words
+        self._oov_words = OrderedDict()
+
     def _grow_vocab_one(self, sentence, new_words):
         assert isinstance(sentence, list)
 
@@ -79,15 +98,64 @@ class SimpleNumericalizer(object):
                 self.vocab.itos.append(word)
                 new_words.append(word)
 
+    def _grow_vocab_one_bounded(self, sentence, new_words, used_words):
+        assert isinstance(sentence, list)
+
+        for word in sentence:
+            used_words.add(word)
+            if word in self._oov_words:
+                self._oov_words.move_to_end(word)
+                continue
+            if word in self.vocab.stoi:
+                continue
+
+            # evict the least recently used word, unless it is needed by the examples being processed
+            # (in which case all the other words are needed too, and the vocabulary must grow)
+            oldest_word = next(iter(self._oov_words), None)
+            if len(self._oov_words) >= self.max_oov_words and oldest_word not in used_words:
+                word_id = self._oov_words.pop(oldest_word)
+                del self.vocab.stoi[oldest_word]
+                self.vocab.itos[word_id] = word
+            else:
+                word_id = len(self.vocab.itos)
+                self.vocab.itos.append(word)
+            self.vocab.stoi[word] = word_id
+            self._oov_words[word] = word_id
+            new_words.append(word)
+
     def grow_vocab(self, examples):
         new_words = []
-        for ex in examples:
-            self._grow_vocab_one(ex.context, new_words)
-            self._grow_vocab_one(ex.question, new_words)
-            self._grow_vocab_one(ex.answer, new_words)
+        if self.max_oov_words is not None:
+            used_words = set()
+            for ex in examples:
+                self._grow_vocab_one_bounded(ex.context, new_words, used_words)
+                self._grow_vocab_one_bounded(ex.question, new_words, used_words)
+                self._grow_vocab_one_bounded(ex.answer, new_words, used_words)
+        else:
+            for ex in examples:
+                self._grow_vocab_one(ex.context, new_words)
+                self._grow_vocab_one(ex.question, new_words)
+                self._grow_vocab_one(ex.answer, new_words)
+        if new_words:
+            self._vocab_version = object()
+        return new_words
+
+    def add_words(self, words):
+        """
+        Add words to the vocabulary in order, like grow_vocab does for the words of examples (e.g. to replay
+        the words that grow_vocab added in a previous run).
+        """
+        new_words = []
+        if self.max_oov_words is not None:
+            self._grow_vocab_one_bounded(list(words), new_words, set())
+        else:
+            self._grow_vocab_one(list(words), new_words)
+        if new_words:
+            self._vocab_version = object()
         return new_words
 
     def _init_vocab(self):
+        self._vocab_version = object()
         self.init_id = self.vocab.stoi[self.init_token]
         self.eos_id = self.vocab.stoi[self.eos_token]
         self.unk_id = self.vocab.stoi[self.unk_token]
@@ -111,6 +179,125 @@ class SimpleNumericalizer(object):
         return list(map(lambda x: 1 if x in special_tokens_tuple else 0, tensor))
 
 
+    def _token_ids(self, tokens, decoder_vocab):
+        """
+        Map tokens to their ids in the vocabulary and in the decoder vocabulary.
+
+        Tokens that are not in the decoder vocabulary get -1, and their positions and words are returned too, because
+        they are assigned an out-of-vocabulary id that depends on the batch.
+        The result is cached on the token list (if it is a TokenList) until the vocabulary changes.
+        """
+        cached = getattr(tokens, 'ids', None)
+        if cached is not None and cached.vocab_version is self._vocab_version and cached.decoder_stoi is decoder_vocab.stoi:
+            return cached.ids, cached.limited, cached.oov_positions, cached.oov_words
+
+        ids = np.array([self.vocab.stoi[word] for word in tokens], dtype=np.int64)
+        limited = np.array([decoder_vocab.stoi.get(word, -1) for word in tokens], dtype=np.int64)
+        oov_positions = np.flatnonzero(limited < 0)
+        oov_words = [tokens[position] for position in oov_positions]
+        try:
+            tokens.ids = TokenIds(self._vocab_version, decoder_vocab.stoi, ids, limited, oov_positions, oov_words)
+        except AttributeError:
+            # not a TokenList, nowhere to cache
+            pass
+        return ids, limited, oov_positions, oov_words
+
+    def set_token_ids(self, tokens, ids, limited, oov_positions):
+        """
+        Cache ids computed ahead of time (e.g. loaded from a NumericalizedExamples cache) on a TokenList.
+
+        The ids must have been computed with the current vocabulary and decoder vocabulary.
+        """
+        oov_words = [tokens[position] for position in oov_positions]
+        tokens.ids = TokenIds(self._vocab_version, self.decoder_vocab.stoi, ids, limited, oov_positions, oov_words)
+
+    def _encode_rows(self, rows, decoder_vocab, device):
+        """
+        Assemble padded tensors from rows of segments.
+
+        Each row is a tuple of a list of segments and the number of padding tokens in the row.
+        Each segment is either a special token, or a tuple of (tokens, number of tokens to keep).
+        """
+        batch_size = len(rows)
+        content_lengths = np.array([sum(1 if isinstance(segment, str) else segment[1] for segment in segments)
+                                    for segments, _pad_count in rows], dtype=np.int64)
+        width = max(int(content_length) + pad_count for content_length, (_segments, pad_count)
+                    in zip(content_lengths, rows))
+        starts = (width - content_lengths) if self.pad_first else np.zeros((batch_size,), dtype=np.int64)
+
+        # special tokens are one-token segments; they are not necessarily in the decoder vocabulary
+        # (e.g. the separator, which is not in the vocabulary at all), in which case they get an
+        # out-of-vocabulary id in order of appearance, like any other word
+        special_segments = dict()
+        segment_rows, segment_cols, segment_lengths = [], [], []
+        all_ids, all_limited = [], []
+        oov_words = []
+        for i, (segments, _pad_count) in enumerate(rows):
+            col = int(starts[i])
+            for segment in segments:
+                if isinstance(segment, str):
+                    special_segment = special_segments.get(segment)
+                    if special_segment is None:
+                        limited_id = decoder_vocab.stoi.get(segment, -1)
+                        special_segment = (np.array([self.vocab.stoi[segment]], dtype=np.int64),
+                                           np.array([limited_id], dtype=np.int64),
+                                           [segment] if limited_id < 0 else [])
+                        special_segments[segment] = special_segment
+                    ids, limited_ids, segment_oov_words = special_segment
+                    segment_rows.append(i)
+                    segment_cols.append(col)
+                    segment_lengths.append(1)
+                    all_ids.append(ids)
+                    all_limited.append(limited_ids)
+                    oov_words.extend(segment_oov_words)
+                    col += 1
+                    continue
+
+                tokens, length = segment
+                if length == 0:
+                    continue
+                ids, limited_ids, oov_positions, segment_oov_words = self._token_ids(tokens, decoder_vocab)
+                segment_rows.append(i)
+                segment_cols.append(col)
+                segment_lengths.append(length)
+                if length == len(tokens):
+                    all_ids.append(ids)
+                    all_limited.append(limited_ids)
+                    oov_words.extend(segment_oov_words)
+                else:
+                    all_ids.append(ids[:length])
+                    all_limited.append(limited_ids[:length])
+                    oov_words.extend(segment_oov_words[:np.searchsorted(oov_positions, length)])
+                col += length
+
+        value = np.full((batch_size, width), self.pad_id, dtype=np.int64)
+        limited = np.full((batch_size, width), decoder_vocab.encode(self.pad_token), dtype=np.int64)
+
+        # place the ids of all the segments with a single indexing operation
+        if segment_lengths:
+            segment_lengths = np.array(segment_lengths, dtype=np.int64)
+            segment_offsets = np.cumsum(segment_lengths) - segment_lengths
+            row_indices = np.repeat(np.array(segment_rows, dtype=np.int64), segment_lengths)
+            col_indices = np.arange(int(segment_lengths.sum()), dtype=np.int64) + \
+                np.repeat(np.array(segment_cols, dtype=np.int64) - segment_offsets, segment_lengths)
+            all_limited = np.concatenate(all_limited)
+
+            # segments are laid out in row-major order, so words outside the decoder vocabulary
+            # get their ids in order of appearance in the batch
+            if oov_words:
+                all_limited[all_limited < 0] = [decoder_vocab.encode(word) for word in oov_words]
+            value[row_indices, col_indices] = np.concatenate(all_ids)
+            limited[row_indices, col_indices] = all_limited
+
+        length = torch.from_numpy(content_lengths.astype(np.int32))
+        value = torch.from_numpy(value)
+        limited = torch.from_numpy(limited)
+        if device is not None:
+            length = length.to(device)
+            value = value.to(device)
+            limited = limited.to(device)
+        return SequentialField(length=length, value=value, limited=limited)
+
     def encode_single(self, minibatch, decoder_vocab, device=None, max_length=-1):
         assert isinstance(minibatch, list)
         
@@ -120,33 +307,12 @@ class SimpleNumericalizer(object):
             max_len = max(len(x[0]) for x in minibatch)
         else:
             max_len = self.fix_length
-        padded = []
-        lengths = []
-        numerical = []
-        decoder_numerical = []
-        for tokens, _mask in minibatch:
-            if self.pad_first:
-                padded_example = [self.pad_token] * max(0, max_len - len(tokens)) + \
-                                 [self.init_token] + \
-                                 list(tokens[:max_len]) + \
-                                 [self.eos_token]
-            else:
-                padded_example = [self.init_token] + \
-                                 list(tokens[:max_len]) + \
-                                 [self.eos_token] + \
-                                 [self.pad_token] * max(0, max_len - len(tokens))
-
-            padded.append(padded_example)
-            lengths.append(len(padded_example) - max(0, max_len - len(tokens)))
-
-            numerical.append([self.vocab.stoi[word] for word in padded_example])
-            decoder_numerical.append([decoder_vocab.encode(word) for word in padded_example])
 
-        length = torch.tensor(lengths, dtype=torch.int32, device=device)
-        numerical = torch.tensor(numerical, dtype=torch.int64, device=device)
-        decoder_numerical = torch.tensor(decoder_numerical, dtype=torch.int64, device=device)
-
-        return SequentialField(length=length, value=numerical, limited=decoder_numerical)
+        rows = []
+        for tokens, _mask in minibatch:
+            rows.append(([self.init_token, (tokens, min(len(tokens), max_len)), self.eos_token],
+                         max(0, max_len - len(tokens))))
+        return self._encode_rows(rows, decoder_vocab, device)
 
 
     def encode_pair(self, minibatch, decoder_vocab, device=None):
@@ -156,38 +322,13 @@ class SimpleNumericalizer(object):
         else:
             # max_len for each example in pair
             max_len = self.fix_length
-        padded = []
-        lengths = []
-        numerical = []
-        decoder_numerical = []
-        for (tokens_a, _), (tokens_b, _)  in minibatch:
-            if self.pad_first:
-                padded_example = [self.pad_token] * max(0, 2 * max_len - len(tokens_a) - len(tokens_b)) + \
-                                 [self.init_token] + \
-                                 list(tokens_a[:max_len]) + \
-                                 [self.sep_token] + \
-                                 list(tokens_b[:max_len]) + \
-                                 [self.eos_token]
-                    
-            else:
-                padded_example = [self.init_token] + \
-                                 list(tokens_a[:max_len]) + \
-                                 [self.sep_token] + \
-                                 list(tokens_b[:max_len]) + \
-                                 [self.eos_token] + \
-                                 [self.pad_token] * max(0, 2 * max_len - len(tokens_a) - len(tokens_b))
-
-            padded.append(padded_example)
-            lengths.append(len(padded_example) - max(0, 2 * max_len - len(tokens_a) - len(tokens_b)))
-
-            numerical.append([self.vocab.stoi[word] for word in padded_example])
-            decoder_numerical.append([decoder_vocab.encode(word) for word in padded_example])
-
-        length = torch.tensor(lengths, dtype=torch.int32, device=device)
-        numerical = torch.tensor(numerical, dtype=torch.int64, device=device)
-        decoder_numerical = torch.tensor(decoder_numerical, dtype=torch.int64, device=device)
 
-        return SequentialField(length=length, value=numerical, limited=decoder_numerical)
+        rows = []
+        for (tokens_a, _), (tokens_b, _) in minibatch:
+            rows.append(([self.init_token, (tokens_a, min(len(tokens_a), max_len)), self.sep_token,
+                          (tokens_b, min(len(tokens_b), max_len)), self.eos_token],
+                         max(0, 2 * max_len - len(tokens_a) - len(tokens_b))))
+        return self._encode_rows(rows, decoder_vocab, device)
   
 
     def decode(self, tensor):
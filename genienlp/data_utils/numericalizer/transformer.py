@@ -28,6 +28,7 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import collections
 import os
+import numpy as np
 import torch
 
 from .decoder_vocab import DecoderVocabulary
@@ -61,6 +62,7 @@ class TransformerNumericalizer(object):
 
     def save(self, save_dir):
         self._tokenizer.save_pretrained(save_dir)
+        self._tokenizer.word_piece_cache.save(save_dir)
         with open(os.path.join(save_dir, 'decoder-vocab.txt'), 'w') as fp:
             for word in self._decoder_words:
                 fp.write(word + '\n')
@@ -68,6 +70,11 @@ class TransformerNumericalizer(object):
     def build_vocab(self, vocab_fields, vocab_sets):
         raise NotImplementedError()
 
+    def set_max_oov_words(self, max_oov_words):
+        # word-piece tokenization covers every word, so the vocabulary only grows with
+        # new opaque tokens, which come from a small, closed set
+        pass
+
     def grow_vocab(self, examples):
         # do a pass over all the data in the dataset and tokenize everything
         # this will add any new tokens that are not to be converted into word-pieces
@@ -109,9 +116,7 @@ class TransformerNumericalizer(object):
         assert isinstance(minibatch, list)
 
         # apply word-piece tokenization to everything first
-        wp_tokenized = []
-        for tokens, mask in minibatch:
-            wp_tokenized.append(self._tokenizer.tokenize(tokens, mask))
+        wp_tokenized = self._tokenize_batch(minibatch)
 
         if max_length > -1:
             max_len = max_length
@@ -122,8 +127,6 @@ class TransformerNumericalizer(object):
 
         padded = []
         lengths = []
-        numerical = []
-        decoder_numerical = []
         for wp_tokens in wp_tokenized:
             if self.pad_first:
                 padded_example = [self.pad_token] * max(0, max_len - len(wp_tokens)) + \
@@ -139,12 +142,51 @@ class TransformerNumericalizer(object):
             padded.append(padded_example)
             lengths.append(len(padded_example) - max(0, max_len - len(wp_tokens)))
 
-            numerical.append(self._tokenizer.convert_tokens_to_ids(padded_example))
-            decoder_numerical.append([decoder_vocab.encode(word) for word in padded_example])
+        return self._numericalize_padded(padded, lengths, decoder_vocab, device)
+
+    def _tokenize_batch(self, minibatch):
+        """
+        Apply word-piece tokenization to a list of (tokens, mask), tokenizing identical sequences only once.
+        """
+        unique_sequences = dict()
+        wp_tokenized = []
+        for tokens, mask in minibatch:
+            key = (tuple(tokens), tuple(mask))
+            wp_tokens = unique_sequences.get(key)
+            if wp_tokens is None:
+                wp_tokens = self._tokenizer.tokenize(tokens, mask)
+                unique_sequences[key] = wp_tokens
+            wp_tokenized.append(wp_tokens)
+        return wp_tokenized
+
+    def _numericalize_padded(self, padded, lengths, decoder_vocab, device):
+        """
+        Convert padded word-piece sequences to ids, looking up every distinct word-piece in the batch only once.
+        """
+        width = max(len(padded_example) for padded_example in padded)
+        if self.pad_first:
+            padded = [[self.pad_token] * (width - len(padded_example)) + padded_example for padded_example in padded]
+        else:
+            padded = [padded_example + [self.pad_token] * (width - len(padded_example)) for padded_example in padded]
+        flat = [word for padded_example in padded for word in padded_example]
+
+        unique_words, first_index, inverse = np.unique(np.array(flat), return_index=True, return_inverse=True)
+        unique_words = unique_words.tolist()
+        unique_ids = np.array(self._tokenizer.convert_tokens_to_ids(unique_words), dtype=np.int64)
+
+        # the decoder vocabulary assigns ids to out-of-vocabulary words in order of appearance,
+        # so encode the distinct words in the order they first appear in the batch
+        unique_limited = np.empty((len(unique_words),), dtype=np.int64)
+        for word_index in np.argsort(first_index, kind='stable'):
+            unique_limited[word_index] = decoder_vocab.encode(unique_words[word_index])
 
+        inverse = inverse.reshape(len(padded), width)
         length = torch.tensor(lengths, dtype=torch.int32, device=device)
-        numerical = torch.tensor(numerical, dtype=torch.int64, device=device)
-        decoder_numerical = torch.tensor(decoder_numerical, dtype=torch.int64, device=device)
+        numerical = torch.from_numpy(unique_ids[inverse])
+        decoder_numerical = torch.from_numpy(unique_limited[inverse])
+        if device is not None:
+            numerical = numerical.to(device)
+            decoder_numerical = decoder_numerical.to(device)
 
         return SequentialField(length=length, value=numerical, limited=decoder_numerical)
 
@@ -163,6 +205,7 @@ class XLMRobertaNumericalizer(TransformerNumericalizer):
         self._tokenizer = MaskedXLMRobertaTokenizer.from_pretrained(save_dir, config=self.config, cache_dir=self._cache)
         # HACK we cannot save the tokenizer without this
         del self._tokenizer.init_kwargs['config']
+        self._tokenizer.word_piece_cache.load(save_dir)
 
         with open(os.path.join(save_dir, 'decoder-vocab.txt'), 'r') as fp:
             self._decoder_words = [line.rstrip('\n') for line in fp]
@@ -205,11 +248,10 @@ class XLMRobertaNumericalizer(TransformerNumericalizer):
 
     def encode_pair(self, minibatch, decoder_vocab, device=None):
         # apply word-piece tokenization to everything first
-        wp_tokenized_a = []
-        wp_tokenized_b = []
-        for (tokens_a, mask_a), (tokens_b, mask_b) in minibatch:
-            wp_tokenized_a.append(self._tokenizer.tokenize(tokens_a, mask_a))
-            wp_tokenized_b.append(self._tokenizer.tokenize(tokens_b, mask_b))
+        # pairs are built from a small set of examples, so most sequences appear several times
+        wp_tokenized = self._tokenize_batch([a for a, _b in minibatch] + [b for _a, b in minibatch])
+        wp_tokenized_a = wp_tokenized[:len(minibatch)]
+        wp_tokenized_b = wp_tokenized[len(minibatch):]
 
         if self.fix_length is None:
             max_len = max(len(wp_a) + len(wp_b) for wp_a, wp_b in zip(wp_tokenized_a, wp_tokenized_b))
@@ -218,9 +260,7 @@ class XLMRobertaNumericalizer(TransformerNumericalizer):
 
         padded = []
         lengths = []
-        numerical = []
-        decoder_numerical = []
-        for (wp_tokens_a, _), (wp_tokens_b, _) in minibatch:
+        for wp_tokens_a, wp_tokens_b in zip(wp_tokenized_a, wp_tokenized_b):
             if self.pad_first:
                 padded_example = [self.pad_token] * max(0, 2 * max_len - len(wp_tokens_a) - len(wp_tokens_b)) + \
                                  [self.init_token] + \
@@ -242,14 +282,7 @@ class XLMRobertaNumericalizer(TransformerNumericalizer):
             padded.append(padded_example)
             lengths.append(len(padded_example) - max(0, 2 * max_len - len(wp_tokens_a) - len(wp_tokens_b)))
 
-            numerical.append(self._tokenizer.convert_tokens_to_ids(padded_example))
-            decoder_numerical.append([decoder_vocab.encode(word) for word in padded_example])
-
-        length = torch.tensor(lengths, dtype=torch.int32, device=device)
-        numerical = torch.tensor(numerical, dtype=torch.int64, device=device)
-        decoder_numerical = torch.tensor(decoder_numerical, dtype=torch.int64, device=device)
-
-        return SequentialField(length=length, value=numerical, limited=decoder_numerical)
+        return self._numericalize_padded(padded, lengths, decoder_vocab, device)
 
     def reverse(self, batch, detokenize, field_name=None):
         with torch.cuda.device_of(batch):
@@ -308,6 +341,7 @@ class BertNumericalizer(TransformerNumericalizer):
         self._tokenizer = MaskedBertTokenizer.from_pretrained(save_dir, config=self.config, cache_dir=self._cache)
         # HACK we cannot save the tokenizer without this
         del self._tokenizer.init_kwargs['config']
+        self._tokenizer.word_piece_cache.load(save_dir)
 
         with open(os.path.join(save_dir, 'decoder-vocab.txt'), 'r') as fp:
             self._decoder_words = [line.rstrip('\n') for line in fp]
@@ -349,11 +383,10 @@ class BertNumericalizer(TransformerNumericalizer):
 
     def encode_pair(self, minibatch, decoder_vocab, device=None):
         # apply word-piece tokenization to everything first
-        wp_tokenized_a = []
-        wp_tokenized_b = []
-        for (tokens_a, mask_a), (tokens_b, mask_b) in minibatch:
-            wp_tokenized_a.append(self._tokenizer.tokenize(tokens_a, mask_a))
-            wp_tokenized_b.append(self._tokenizer.tokenize(tokens_b, mask_b))
+        # pairs are built from a small set of examples, so most sequences appear several times
+        wp_tokenized = self._tokenize_batch([a for a, _b in minibatch] + [b for _a, b in minibatch])
+        wp_tokenized_a = wp_tokenized[:len(minibatch)]
+        wp_tokenized_b = wp_tokenized[len(minibatch):]
 
         if self.fix_length is None:
             max_len = max(len(wp_a) + len(wp_b) for wp_a, wp_b in zip(wp_tokenized_a, wp_tokenized_b))
@@ -362,9 +395,7 @@ class BertNumericalizer(TransformerNumericalizer):
 
         padded = []
         lengths = []
-        numerical = []
-        decoder_numerical = []
-        for (wp_tokens_a, _), (wp_tokens_b, _) in minibatch:
+        for wp_tokens_a, wp_tokens_b in zip(wp_tokenized_a, wp_tokenized_b):
             if self.pad_first:
                 padded_example = [self.pad_token] * max(0, 2 * max_len - len(wp_tokens_a) - len(wp_tokens_b)) + \
                                  [self.init_token] + \
@@ -384,14 +415,7 @@ class BertNumericalizer(TransformerNumericalizer):
             padded.append(padded_example)
             lengths.append(len(padded_example) - max(0, 2 * max_len - len(wp_tokens_a) - len(wp_tokens_b)))
 
-            numerical.append(self._tokenizer.convert_tokens_to_ids(padded_example))
-            decoder_numerical.append([decoder_vocab.encode(word) for word in padded_example])
-
-        length = torch.tensor(lengths, dtype=torch.int32, device=device)
-        numerical = torch.tensor(numerical, dtype=torch.int64, device=device)
-        decoder_numerical = torch.tensor(decoder_numerical, dtype=torch.int64, device=device)
-
-        return SequentialField(length=length, value=numerical, limited=decoder_numerical)
+        return self._numericalize_padded(padded, lengths, decoder_vocab, device)
 
     def reverse(self, batch, detokenize, field_name=None):
         with torch.cuda.device_of(batch):
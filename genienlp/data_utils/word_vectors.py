@@ -1,22 +1,28 @@
-import array
-import io
 import logging
 import os
 import zipfile
 import numpy as np
 import gzip
 import shutil
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+from multiprocessing import Pool, cpu_count
 
-import six
 from six.moves.urllib.request import urlretrieve
 import torch
 from tqdm import tqdm
 import tarfile
 
-from .hash_table import HashTable
+from .hash_table import HashTable, StringArray
 
 logger = logging.getLogger(__name__)
 MAX_WORD_LENGTH = 100
+# size in bytes of each piece of a text embedding file that is parsed in parallel
+CHUNK_SIZE = 64 * 1024 * 1024
+# number of rows converted at a time when quantizing cached vectors
+QUANTIZE_BLOCK_SIZE = 65536
+VECTORS_DTYPES = ['float32', 'float16', 'int8']
 
 
 pretrained_aliases = {
@@ -57,10 +63,174 @@ def reporthook(t):
     return inner
 
 
+def _read_chunk_lines(path, start, end):
+    """Read the lines that start within the byte range [start, end) of a file"""
+    with open(path, 'rb') as f:
+        if start > 0:
+            # skip the line that started in the previous chunk (or just the newline that ended it)
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        if position >= end:
+            return []
+        data = f.read(end - position)
+        if not data.endswith(b'\n'):
+            # read the rest of the last line, which spills into the next chunk
+            data += f.readline()
+    return data.split(b'\n')
+
+
+def _split_vector_line(line):
+    """Split a line of a text embedding file into the word and the (still unparsed) vector"""
+    # Explicitly splitting on " " is important, so we don't
+    # get rid of Unicode non-breaking spaces in the vectors.
+    word, sep, vector = line.rstrip().partition(b' ')
+    num_entries = vector.count(b' ') + 1 if sep else 0
+    return word, vector, num_entries
+
+
+def _find_vectors_dim(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            word, _vector, num_entries = _split_vector_line(line)
+            if num_entries > 1:
+                return num_entries
+    raise RuntimeError('no vectors found in {}'.format(path))
+
+
+def _parse_vectors_chunk(path, start, end, dim, vectors_path=None, row_offset=0):
+    """Parse the lines of a text embedding file in the byte range [start, end)
+
+    If vectors_path is None, this returns the number of valid rows in the chunk.
+    Otherwise, it writes the parsed vectors into the .npy file at vectors_path, starting
+    at row_offset, and returns the list of words.
+    """
+    words, vectors = [], []
+    for line in _read_chunk_lines(path, start, end):
+        word, vector, num_entries = _split_vector_line(line)
+        if not word and not num_entries:
+            continue
+        if num_entries == 1:
+            if vectors_path is not None:
+                logger.warning("Skipping token {} with 1-dimensional "
+                               "vector {}; likely a header".format(word, vector))
+            continue
+        elif num_entries != dim:
+            raise RuntimeError(
+                "Vector for token {} has {} dimensions, but previously "
+                "read vectors have {} dimensions. All vectors must have "
+                "the same number of dimensions.".format(word, num_entries, dim))
+
+        try:
+            word = word.decode('utf-8')
+        except UnicodeDecodeError:
+            if vectors_path is not None:
+                logger.info("Skipping non-UTF8 token {}".format(repr(word)))
+            continue
+
+        if len(word) > MAX_WORD_LENGTH:
+            continue
+        words.append(word)
+        vectors.append(vector)
+
+    if vectors_path is None:
+        return len(words)
+    if not words:
+        return words
+
+    # convert all the floats of the chunk at once
+    values = np.fromstring(b' '.join(vectors), dtype=np.float64, sep=' ')
+    if values.shape[0] != len(words) * dim:
+        raise RuntimeError('malformed vectors in {} between bytes {} and {}'.format(path, start, end))
+    output = np.load(vectors_path, mmap_mode='r+')
+    output[row_offset:row_offset + len(words)] = values.reshape(len(words), dim)
+    output.flush()
+    del output
+    return words
+
+
+def _parse_vectors_chunk_star(args):
+    return _parse_vectors_chunk(*args)
+
+
+def quantize_vectors(vectors, dtype):
+    """Convert an array of float32 vectors to the given storage dtype
+
+    Returns a tuple of the converted vectors and their per-row scales, which are None unless dtype is int8.
+    """
+    if dtype == 'float16':
+        return vectors.astype(np.float16), None
+    elif dtype == 'int8':
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        values = np.rint(vectors / scales[:, np.newaxis]).astype(np.int8)
+        return values, scales.astype(np.float32)
+    else:
+        return vectors, None
+
+
+def vectors_cache_path(path, dtype):
+    """The file that holds the vectors of a cache with the given storage dtype (not including the scales)"""
+    if dtype == 'float32':
+        return path + '.vectors.npy'
+    return path + '.vectors.{}.npy'.format(dtype)
+
+
+def find_vectors_cache_dtype(path, preferred_dtype='float32'):
+    """The storage dtype of the vectors saved at path, or None if there are none
+
+    If the vectors were saved with more than one dtype, preferred_dtype is chosen when available.
+    """
+    for dtype in [preferred_dtype] + VECTORS_DTYPES:
+        if os.path.isfile(vectors_cache_path(path, dtype)):
+            return dtype
+    return None
+
+
+def save_quantized_vectors(path, vectors, dtype):
+    """Quantize the float32 vectors of a cache to the given dtype, and save them next to the cache
+
+    The vectors are converted a block at a time, so they can be a memory-mapped array larger than memory.
+    """
+    path_quantized_np = vectors_cache_path(path, dtype)
+    logger.info('Saving {} vectors to {}'.format(dtype, path_quantized_np))
+    values = np.lib.format.open_memmap(path_quantized_np + '.tmp', mode='w+', dtype=dtype, shape=vectors.shape)
+    scales = None
+    if dtype == 'int8':
+        scales = np.lib.format.open_memmap(path + '.scales.npy.tmp', mode='w+', dtype=np.float32,
+                                           shape=(vectors.shape[0],))
+    for start in range(0, vectors.shape[0], QUANTIZE_BLOCK_SIZE):
+        end = start + QUANTIZE_BLOCK_SIZE
+        block_values, block_scales = quantize_vectors(np.asarray(vectors[start:end], dtype=np.float32), dtype)
+        values[start:end] = block_values
+        if scales is not None:
+            scales[start:end] = block_scales
+    del values
+    if scales is not None:
+        del scales
+        os.replace(path + '.scales.npy.tmp', path + '.scales.npy')
+    # move the vectors in place last, because their presence marks the cache as complete
+    os.replace(path_quantized_np + '.tmp', path_quantized_np)
+
+
+def save_vectors(path, itos, vectors, dtype='float32'):
+    """Save vectors in the same format as the cache of `Vectors`, so they can be loaded with `Vectors(path)`"""
+    stoi = HashTable(itos)
+    stoi.itos.save(path + '.itos')
+    np.save(path + '.table.npy', stoi.table)
+    vectors = vectors.numpy().astype(np.float32, copy=False)
+    if dtype == 'float32':
+        np.save(vectors_cache_path(path, dtype), vectors)
+    else:
+        save_quantized_vectors(path, vectors, dtype)
+
+
 class Vectors(object):
+    # per-row scales of int8 vectors
+    scales = None
 
     def __init__(self, name, cache='.vector_cache',
-                 url=None, unk_init=torch.Tensor.zero_):
+                 url=None, unk_init=torch.Tensor.zero_, dtype='float32'):
         """Arguments:
                name: name of the file that contains the vectors
                cache: directory for cached vectors
@@ -68,27 +238,61 @@ class Vectors(object):
                unk_init (callback): by default, initalize out-of-vocabulary word vectors
                    to zero vectors; can be any function that takes in a Tensor and
                    returns a Tensor of the same size
+               dtype: how to store and memory-map the cached vectors: float32, float16,
+                   or int8 with one scale per row; lookups always return float32 vectors
          """
         self.unk_init = unk_init
+        self.dtype = dtype
         self.cache(name, cache, url=url)
 
+    def _rows(self, indices):
+        # dequantize only the rows we look up
+        rows = self.vectors[indices].to(dtype=torch.float32)
+        if self.scales is not None:
+            rows *= self.scales[indices].unsqueeze(-1)
+        return rows
+
     def __getitem__(self, token):
         if token in self.stoi:
-            return self.vectors[self.stoi[token]]
+            return self._rows(self.stoi[token])
         else:
             return self.unk_init(torch.Tensor(1, self.dim))
 
+    def lookup_many(self, tokens):
+        """Look up the vectors of many tokens at once, and return them as a [len(tokens), dim] tensor"""
+        if isinstance(self.stoi, HashTable):
+            indices = self.stoi.get_many(tokens)
+        else:
+            indices = np.array([self.stoi.get(token, -1) for token in tokens], dtype=np.int64)
+
+        found = indices >= 0
+        vectors = torch.empty(len(tokens), self.dim)
+        # gather all the vectors with a single indexing operation
+        vectors[torch.from_numpy(np.flatnonzero(found))] = self._rows(torch.from_numpy(indices[found]))
+        num_missing = len(tokens) - int(found.sum())
+        if num_missing > 0:
+            vectors[torch.from_numpy(np.flatnonzero(~found))] = self.unk_init(torch.Tensor(num_missing, self.dim))
+        return vectors
+
     def cache(self, name, cache, url=None):
         if os.path.isfile(name):
             path = name
-            path_vectors_np = os.path.join(cache, os.path.basename(name)) + '.vectors.npy'
-            path_itos_np = os.path.join(cache, os.path.basename(name)) + '.itos.npy'
-            path_table_np = os.path.join(cache, os.path.basename(name)) + '.table.npy'
+            path_cache = os.path.join(cache, os.path.basename(name))
         else:
             path = os.path.join(cache, name)
-            path_vectors_np = path + '.vectors.npy'
-            path_itos_np = path + '.itos.npy'
-            path_table_np = path + '.table.npy'
+            path_cache = path
+        self.path_cache = path_cache
+        path_vectors_np = vectors_cache_path(path_cache, 'float32')
+        path_quantized_np = vectors_cache_path(path_cache, self.dtype)
+        path_itos = path_cache + '.itos'
+        path_table_np = path_cache + '.table.npy'
+
+        if self.dtype != 'float32' and os.path.isfile(path_quantized_np):
+            logger.info('Loading vectors from {}'.format(path_quantized_np))
+            self._load_cache(path_quantized_np, path_itos, path_table_np)
+            if self.dtype == 'int8':
+                self.scales = torch.from_numpy(np.load(path_cache + '.scales.npy', mmap_mode='r'))
+            return
 
         if not os.path.isfile(path_vectors_np):
             if not os.path.isfile(path) and url:
@@ -113,91 +317,63 @@ class Vectors(object):
             if not os.path.isfile(path):
                 raise RuntimeError('no vectors found at {}'.format(path))
 
-            # str call is necessary for Python 2/3 compatibility, since
-            # argument must be Python 2 str (Python 3 bytes) or
-            # Python 3 str (Python 2 unicode)
-            itos, vectors, dim = [], array.array(str('d')), None
-
-            # Try to read the whole file with utf-8 encoding.
-            binary_lines = False
-            try:
-                with io.open(path, encoding="utf8") as f:
-                    lines = [line for line in f]
-            # If there are malformed lines, read in binary mode
-            # and manually decode each word from utf-8
-            except:
-                logger.warning("Could not read {} as UTF8 file, "
-                               "reading file as bytes and skipping "
-                               "words with malformed UTF8.".format(path))
-                with open(path, 'rb') as f:
-                    lines = [line for line in f]
-                binary_lines = True
-
             logger.info("Loading vectors from {}".format(path))
-            vectors = None
-            i = 0
-            for line in tqdm(lines, total=len(lines)):
-                # Explicitly splitting on " " is important, so we don't
-                # get rid of Unicode non-breaking spaces in the vectors.
-                entries = line.rstrip().split(b" " if binary_lines else " ")
-
-                word, entries = entries[0], entries[1:]
-                if dim is None and len(entries) > 1:
-                    dim = len(entries)
-                    vectors = np.zeros((len(lines), dim), dtype=np.float32)
-                elif len(entries) == 1:
-                    logger.warning("Skipping token {} with 1-dimensional "
-                                   "vector {}; likely a header".format(word, entries))
-                    continue
-                elif dim != len(entries):
-                    raise RuntimeError(
-                        "Vector for token {} has {} dimensions, but previously "
-                        "read vectors have {} dimensions. All vectors must have "
-                        "the same number of dimensions.".format(word, len(entries), dim))
-
-                if binary_lines:
-                    try:
-                        if isinstance(word, six.binary_type):
-                            word = word.decode('utf-8')
-                    except:
-                        logger.info("Skipping non-UTF8 token {}".format(repr(word)))
-                        continue
-
-                if len(word) > MAX_WORD_LENGTH:
-                    continue
-                vectors[i] = [float(x) for x in entries]
-                i += 1
-                itos.append(word)
-            del lines
-
-            # we dropped some words because they were too long, so now vectors
-            # has some empty entries at the end
-            assert len(itos) <= vectors.shape[0]
-            vectors = vectors[:len(itos)]
+            dim = _find_vectors_dim(path)
+            file_size = os.path.getsize(path)
+            num_chunks = max(1, min(file_size // CHUNK_SIZE + 1, 1024))
+            chunk_starts = [file_size * i // num_chunks for i in range(num_chunks)]
+            chunks = [(path, start, end, dim) for start, end in zip(chunk_starts, chunk_starts[1:] + [file_size])]
+
+            with closing(Pool(min(cpu_count(), num_chunks))) as pool:
+                # first pass: count the valid rows in each chunk, so we know where each chunk goes in the output
+                chunk_sizes = pool.starmap(_parse_vectors_chunk, chunks)
+                row_offsets = np.cumsum([0] + chunk_sizes)
+
+                # second pass: parse the vectors and write them straight into the memory-mapped output file
+                path_vectors_tmp = path_vectors_np + '.tmp'
+                vectors = np.lib.format.open_memmap(path_vectors_tmp, mode='w+', dtype=np.float32,
+                                                    shape=(int(row_offsets[-1]), dim))
+                del vectors
+                itos = []
+                for words in tqdm(pool.imap(_parse_vectors_chunk_star,
+                                            [chunk + (path_vectors_tmp, int(offset)) for chunk, offset in zip(chunks, row_offsets)]),
+                                  total=num_chunks):
+                    itos += words
 
             self.stoi = HashTable(itos)
             self.itos = self.stoi.itos
             del itos
-            assert self.itos.shape[0] == vectors.shape[0]
 
             print('Saving vectors to {}'.format(path_vectors_np))
 
-            np.save(path_vectors_np, vectors)
-            np.save(path_itos_np, self.itos)
+            self.itos.save(path_itos)
             np.save(path_table_np, self.stoi.table)
+            # move the vectors in place last, because their presence marks the cache as complete
+            os.replace(path_vectors_tmp, path_vectors_np)
 
-            self.vectors = torch.from_numpy(vectors)
+            self.vectors = torch.from_numpy(np.load(path_vectors_np, mmap_mode='r'))
             self.dim = dim
+            assert self.itos.shape[0] == self.vectors.shape[0]
         else:
             logger.info('Loading vectors from {}'.format(path_vectors_np))
+            self._load_cache(path_vectors_np, path_itos, path_table_np)
 
-            vectors = np.load(path_vectors_np, mmap_mode='r')
-            itos = np.load(path_itos_np, mmap_mode='r')
-            table = np.load(path_table_np, mmap_mode='r')
-            self.stoi = HashTable(itos, table)
-            self.itos = self.stoi.itos
-            self.vectors = torch.from_numpy(vectors)
-            self.dim = self.vectors.size()[1]
+        if self.dtype != 'float32':
+            save_quantized_vectors(path_cache, self.vectors.numpy(), self.dtype)
+            self.cache(name, cache, url=url)
+
+    def _load_cache(self, path_vectors_np, path_itos, path_table_np):
+        vectors = np.load(path_vectors_np, mmap_mode='r')
+        if os.path.isfile(path_itos + '.offsets.npy'):
+            itos = StringArray.load(path_itos, mmap_mode='r')
+        else:
+            # caches saved by older versions store itos as a single 'U' array
+            itos = np.load(path_itos + '.npy', mmap_mode='r')
+        table = np.load(path_table_np, mmap_mode='r')
+        self.stoi = HashTable(itos, table)
+        self.itos = self.stoi.itos
+        self.vectors = torch.from_numpy(vectors)
+        self.dim = self.vectors.size()[1]
 
 
 class GloVe(Vectors):
@@ -228,27 +404,206 @@ class CharNGram(Vectors):
     url = ('http://www.logos.t.u-tokyo.ac.jp/~hassy/publications/arxiv2016jmt/'
            'jmt_pre-trained_embeddings.tar.gz')
 
+    # number of token vectors to keep in memory
+    memo_size = 100000
+    # number of token vectors to keep in the memo on disk; the least recently computed ones are dropped
+    memo_disk_size = 500000
+    # save the memo of token vectors to disk when a single lookup computes at least this many new
+    # vectors, as when initializing the embedding for a vocabulary
+    memo_save_threshold = 1000
+
     def __init__(self, **kwargs):
         super(CharNGram, self).__init__(self.name, url=self.url, **kwargs)
 
-    def __getitem__(self, token):
-        vector = torch.Tensor(1, self.dim).zero_()
-        if token == "<unk>":
-            return self.unk_init(vector)
+        # token vectors are memoized in a bounded LRU in memory, and in a memo saved next to the
+        # cached n-gram vectors, so the vectors of known tokens do not need to be computed again
+        # after the process restarts
+        self._lru = OrderedDict()
+        self._memo_path = self.path_cache + '.memo' + ('' if self.dtype == 'float32' else '.' + self.dtype)
+        self._memo = self._load_memo()
+
+    def _memo_version_path(self, version):
+        return os.path.join(self._memo_path + '.' + version, 'memo')
+
+    def _read_memo_version(self):
+        try:
+            with open(self._memo_path + '.version') as fp:
+                return fp.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _load_memo(self):
+        # the memo is saved in a new directory each time, and the version file, which is replaced
+        # atomically once the directory is complete, names the current one
+        version = None
+        while True:
+            try:
+                previous_version, version = version, self._read_memo_version()
+                if version is None:
+                    return None
+                path = self._memo_version_path(version)
+                itos = StringArray.load(path + '.itos', mmap_mode='r')
+                table = np.load(path + '.table.npy', mmap_mode='r')
+                vectors = np.load(path + '.vectors.npy', mmap_mode='r')
+                return HashTable(itos, table), torch.from_numpy(vectors)
+            except (OSError, ValueError) as e:
+                # another process replaced the version we were loading, and removed it
+                if version != previous_version and version != self._read_memo_version():
+                    continue
+                logger.warning('Ignoring unreadable memo of char n-gram vectors at {}: {}'.format(self._memo_path, e))
+                return None
+
+    def _save_memo(self, new_tokens, new_vectors):
+        tokens = new_tokens[-self.memo_disk_size:]
+        vectors = new_vectors[-self.memo_disk_size:]
+
+        # merge with the latest version, which another process may have saved since we loaded ours, and keep
+        # the most recently computed vectors, so that the memo does not grow without bound
+        memo = self._load_memo()
+        if memo is not None and len(tokens) < self.memo_disk_size:
+            memo_stoi, memo_vectors = memo
+            new_token_set = set(tokens)
+            keep = np.flatnonzero([token not in new_token_set for token in memo_stoi.itos])
+            keep = keep[max(0, keep.shape[0] - (self.memo_disk_size - len(tokens))):]
+            if keep.shape[0] > 0:
+                tokens = [memo_stoi.itos[i] for i in keep] + tokens
+                vectors = torch.cat([memo_vectors[torch.from_numpy(keep)].to(dtype=torch.float32), vectors], dim=0)
+
+        # every writer saves to its own version, so concurrent writers never write to the same files
+        version = '{}-{}'.format(os.getpid(), uuid.uuid4().hex)
+        version_tmp = self._memo_path + '.version.' + version + '.tmp'
+        try:
+            os.makedirs(self._memo_path + '.' + version)
+            save_vectors(self._memo_version_path(version), tokens, vectors)
+            with open(version_tmp, 'w') as fp:
+                fp.write(version)
+            previous_version = self._read_memo_version()
+            os.replace(version_tmp, self._memo_path + '.version')
+        except OSError as e:
+            logger.warning('Could not save memo of char n-gram vectors to {}: {}'.format(self._memo_path, e))
+            shutil.rmtree(self._memo_path + '.' + version, ignore_errors=True)
+            if os.path.exists(version_tmp):
+                os.remove(version_tmp)
+            return
+        # processes that already memory-mapped the previous version keep reading it after it is removed
+        if previous_version is not None and previous_version != version:
+            shutil.rmtree(self._memo_path + '.' + previous_version, ignore_errors=True)
+        self._memo = self._load_memo()
+
+    def _remember(self, token, vector):
+        self._lru[token] = vector
+        self._lru.move_to_end(token)
+        if len(self._lru) > self.memo_size:
+            self._lru.popitem(last=False)
+
+    @staticmethod
+    def _gram_keys(token):
         # These literals need to be coerced to unicode for Python 2 compatibility
         # when we try to join them with read ngrams from the files.
         chars = ['#BEGIN#'] + list(token) + ['#END#']
-        num_vectors = 0
         for n in [2, 3, 4]:
             end = len(chars) - n + 1
             grams = [chars[i:(i + n)] for i in range(end)]
             for gram in grams:
-                gram_key = '{}gram-{}'.format(n, ''.join(gram))
-                if gram_key in self.stoi:
-                    vector += self.vectors[self.stoi[gram_key]]
-                    num_vectors += 1
-        if num_vectors > 0:
-            vector /= num_vectors
-        else:
-            vector = self.unk_init(vector)
-        return vector
+                yield '{}gram-{}'.format(n, ''.join(gram))
+
+    def __getitem__(self, token):
+        return self.lookup_many([token])
+
+    def _compute_many(self, tokens):
+        # look up the n-grams of all tokens at once, then average them per token
+        gram_keys = []
+        gram_owners = []
+        for ti, token in enumerate(tokens):
+            if token == "<unk>":
+                continue
+            for gram_key in self._gram_keys(token):
+                gram_keys.append(gram_key)
+                gram_owners.append(ti)
+        gram_indices = self.stoi.get_many(gram_keys)
+        found = gram_indices >= 0
+        gram_owners = torch.tensor(gram_owners, dtype=torch.int64)[torch.from_numpy(found)]
+
+        vectors = torch.zeros(len(tokens), self.dim)
+        vectors.index_add_(0, gram_owners, self._rows(torch.from_numpy(gram_indices[found])))
+        num_vectors = torch.bincount(gram_owners, minlength=len(tokens))
+
+        has_vectors = num_vectors > 0
+        vectors[has_vectors] /= num_vectors[has_vectors].unsqueeze(1).to(dtype=vectors.dtype)
+        num_missing = len(tokens) - int(has_vectors.sum())
+        if num_missing > 0:
+            vectors[~has_vectors] = self.unk_init(torch.zeros(num_missing, self.dim))
+        return vectors, has_vectors
+
+    def lookup_many(self, tokens):
+        vectors = torch.empty(len(tokens), self.dim)
+
+        missing = []
+        for ti, token in enumerate(tokens):
+            vector = self._lru.get(token)
+            if vector is None:
+                missing.append(ti)
+            else:
+                self._lru.move_to_end(token)
+                vectors[ti] = vector
+
+        if missing and self._memo is not None:
+            memo_stoi, memo_vectors = self._memo
+            memo_indices = memo_stoi.get_many([tokens[ti] for ti in missing])
+            found = memo_indices >= 0
+            found_in_memo = [missing[i] for i in np.flatnonzero(found)]
+            memo_rows = memo_vectors[torch.from_numpy(memo_indices[found])].to(dtype=torch.float32)
+            vectors[found_in_memo] = memo_rows
+            for ti, vector in zip(found_in_memo, memo_rows):
+                # clone the rows, or each one would keep all of memo_rows alive
+                self._remember(tokens[ti], vector.clone())
+            missing = [missing[i] for i in np.flatnonzero(~found)]
+
+        if missing:
+            computed, has_vectors = self._compute_many([tokens[ti] for ti in missing])
+            vectors[missing] = computed
+
+            # only memoize tokens that have n-gram vectors, because unk_init can be random
+            new_tokens = []
+            new_rows = []
+            for ti, vector, memoize in zip(missing, computed, has_vectors.tolist()):
+                if memoize and tokens[ti] not in self._lru:
+                    self._remember(tokens[ti], vector.clone())
+                    new_tokens.append(tokens[ti])
+                    new_rows.append(vector)
+            if len(new_tokens) >= self.memo_save_threshold:
+                self._save_memo(new_tokens, torch.stack(new_rows, dim=0))
+        return vectors
+
+
+class VocabVectors(Vectors):
+    """Vectors restricted to the vocabulary of a model, as saved by `genienlp export`
+
+    Words outside the vocabulary are looked up in the full table returned by `load_fallback`,
+    which is only loaded the first time it is needed. If `load_fallback` is None, they are
+    initialized with `unk_init` instead.
+    """
+
+    def __init__(self, name, cache, load_fallback=None, **kwargs):
+        self._load_fallback = load_fallback
+        self._fallback = None
+        super().__init__(name, cache, **kwargs)
+
+    def _get_fallback(self):
+        if self._fallback is None:
+            logger.info('Loading the full embedding table for words outside the exported vocabulary')
+            self._fallback = self._load_fallback()
+        return self._fallback
+
+    def __getitem__(self, token):
+        if self._load_fallback is None or token in self.stoi:
+            return super().__getitem__(token)
+        return self._get_fallback()[token]
+
+    def lookup_many(self, tokens):
+        vectors = super().lookup_many(tokens)
+        if self._load_fallback is not None:
+            missing = np.flatnonzero(self.stoi.get_many(tokens) < 0)
+            if missing.shape[0] > 0:
+                vectors[torch.from_numpy(missing)] = self._get_fallback().lookup_many([tokens[i] for i in missing])
+        return vectors
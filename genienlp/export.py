@@ -31,7 +31,7 @@ import logging
 import os
 import shutil
 
-from .data_utils.embeddings import load_embeddings
+from .data_utils.embeddings import load_embeddings, save_vocab_embeddings, VECTORS_DTYPE_CHOICES, VECTORS_DTYPE_HELP
 from .util import load_config_json
 
 logger = logging.getLogger(__name__)
@@ -41,10 +41,14 @@ def parse_argv(parser):
     parser.add_argument('--path', required=True,
                         help='the model training directory to export')
     parser.add_argument('--embeddings', default='.embeddings/', type=str, help='where to load embeddings from')
+    parser.add_argument('--vectors_dtype', default='float32', choices=VECTORS_DTYPE_CHOICES, help=VECTORS_DTYPE_HELP)
     parser.add_argument('--checkpoint_name', default='best.pth',
                         help='Checkpoint file to use (relative to --path, defaults to best.pth)')
     parser.add_argument('-o', '--output', required=True,
                         help='the directory where to export into')
+    parser.add_argument('--vocab_embeddings', action='store_true',
+                        help='also export the rows of the word vectors that match the vocabulary of the model, so the model '
+                             'can be loaded without the full word vector files')
 
 
 def main(args):
@@ -65,6 +69,11 @@ def main(args):
     numericalizer.load(args.path)
     numericalizer.save(args.output)
 
+    if args.vocab_embeddings:
+        emb_names = '+'.join([args.context_embeddings, args.question_embeddings, args.decoder_embeddings]).split('+')
+        save_vocab_embeddings(args.output, args.embeddings, emb_names, numericalizer.vocab,
+                              vectors_dtype=args.vectors_dtype)
+
     # now copy over the config.json and checkpoint file
     for fn in ['config.json', args.checkpoint_name]:
         src = os.path.join(args.path, fn)
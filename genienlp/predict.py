@@ -46,58 +46,85 @@ except RuntimeError:
 import torch
 
 from . import models
-from .data_utils.embeddings import load_embeddings
+from .data_utils.embeddings import load_embeddings, VOCAB_EMBEDDINGS_DIR, VECTORS_DTYPE_CHOICES, VECTORS_DTYPE_HELP, \
+    VECTORS_ON_DEVICE_HELP
 from .tasks.registry import get_tasks
-from .util import set_seed, preprocess_examples, load_config_json, make_data_loader, log_model_size, init_devices, \
-    have_multilingual, combine_folders_on_disk, split_folder_on_disk, get_part_path
+from .util import set_seed, preprocess_examples, load_numericalized_splits, load_config_json, make_data_loader, \
+    log_model_size, init_devices, have_multilingual, combine_folders_on_disk, split_folder_on_disk, get_part_path
 from .validate import generate_with_model, calculate_and_reduce_metrics
 
 logger = logging.getLogger(__name__)
 
 
-def get_all_splits(args):
+def get_split_kwargs(args, task, task_languages):
+    kwargs = {'train': None}
+    if args.evaluate == 'valid':
+        kwargs['test'] = None
+        if args.pred_set_name is not None:
+            kwargs['validation'] = args.pred_set_name
+    elif args.evaluate == 'test':
+        kwargs['validation'] = None
+    else:
+        raise ValueError('Split used for prediction should be either valid or test')
+
+    kwargs.update({'skip_cache': args.skip_cache, 'subsample': args.subsample,
+                   'cached_path': os.path.join(args.cache, task.name), 'all_dirs': task_languages,
+                   'almond_lang_as_question': args.almond_lang_as_question})
+
+    kwargs['separate_eval'] = args.separate_eval
+    return kwargs
+
+
+def load_task_splits(args, task, kwargs):
+    task_splits = task.get_splits(root=args.data, lower=args.lower, **kwargs)
+    if not isinstance(task_splits, list):
+        task_splits = [task_splits]
+    task_split_processed = []
+    for split in task_splits:
+        assert (split.eval or split.test) and not split.train and not split.aux
+        split = split.eval if split.eval else split.test
+        preprocess_examples(args, [task], [split], train=False)
+        task_split_processed.append(split)
+    return task_split_processed
+
+
+def get_all_splits(args, numericalizer=None):
+    """
+    Load the splits of each task. With a numericalizer and --numericalized_cache, the splits are loaded
+    from the numericalized cache if possible, and their words are added to the vocabulary.
+
+    Returns the splits of each task and the words added to the vocabulary.
+    """
     splits = []
+    new_words = []
     if len(args.pred_languages) == 1 and len(args.tasks) > 1:
         args.pred_languages *= len(args.tasks)
     for i, task in enumerate(args.tasks):
         task_languages = args.pred_languages[i]
         logger.info(f'Loading {task}')
-        kwargs = {'train': None}
-        if args.evaluate == 'valid':
-            kwargs['test'] = None
-            if args.pred_set_name is not None:
-                kwargs['validation'] = args.pred_set_name
-        elif args.evaluate == 'test':
-            kwargs['validation'] = None
+        kwargs = get_split_kwargs(args, task, task_languages)
+        if numericalizer is not None and args.numericalized_cache:
+            task_splits, task_new_words = load_numericalized_splits(args, task, kwargs,
+                                                                    lambda: load_task_splits(args, task, kwargs),
+                                                                    numericalizer, train=False, grow_vocab=True,
+                                                                    logger=logger)
+            new_words += task_new_words
         else:
-            raise ValueError('Split used for prediction should be either valid or test')
-        
-        kwargs.update({'skip_cache': args.skip_cache, 'subsample': args.subsample,
-                       'cached_path': os.path.join(args.cache, task.name), 'all_dirs': task_languages,
-                       'almond_lang_as_question': args.almond_lang_as_question})
-        
-        kwargs['separate_eval'] = args.separate_eval
-        task_splits = task.get_splits(root=args.data, lower=args.lower, **kwargs)
-        if not isinstance(task_splits, list):
-            task_splits = [task_splits]
-        task_split_processed = []
-        for split in task_splits:
-            assert (split.eval or split.test) and not split.train and not split.aux
-            split = split.eval if split.eval else split.test
-            preprocess_examples(args, [task], [split], train=False)
-            task_split_processed.append(split)
-        splits.append(task_split_processed)
-    return splits
+            task_splits = load_task_splits(args, task, kwargs)
+        splits.append(task_splits)
+    return splits, new_words
 
 
 def prepare_data(args, numericalizer, embeddings):
-    splits = get_all_splits(args)
     logger.info(f'Vocabulary has {numericalizer.num_tokens} tokens from training')
-    new_words = []
-    for task_splits in splits:
-        for split in task_splits:
-            new_words += numericalizer.grow_vocab(split)
-            logger.info(f'Vocabulary has expanded to {numericalizer.num_tokens} tokens')
+    if args.numericalized_cache:
+        splits, new_words = get_all_splits(args, numericalizer)
+    else:
+        splits, new_words = get_all_splits(args)
+        for task_splits in splits:
+            for split in task_splits:
+                new_words += numericalizer.grow_vocab(split)
+    logger.info(f'Vocabulary has expanded to {numericalizer.num_tokens} tokens')
 
     for emb in embeddings:
         emb.grow_for_vocab(numericalizer.vocab, new_words)
@@ -108,7 +135,10 @@ def prepare_data(args, numericalizer, embeddings):
 def run(args, device):
     numericalizer, context_embeddings, question_embeddings, decoder_embeddings = \
         load_embeddings(args.embeddings, args.context_embeddings, args.question_embeddings, args.decoder_embeddings,
-                        args.max_generative_vocab, logger)
+                        args.max_generative_vocab, logger,
+                        vocab_embeddings_dir=os.path.join(args.path, VOCAB_EMBEDDINGS_DIR) if args.vocab_embeddings else None,
+                        vocab_embeddings_fallback=args.vocab_embeddings_fallback,
+                        vectors_dtype=args.vectors_dtype, vectors_on_device=args.vectors_on_device)
     numericalizer.load(args.path)
     for emb in set(context_embeddings + question_embeddings + decoder_embeddings):
         emb.init_for_vocab(numericalizer.vocab)
@@ -225,8 +255,16 @@ def parse_argv(parser):
     parser.add_argument('--seed', default=123, type=int, help='Random seed.')
     parser.add_argument('--data', default='.data/', type=str, help='where to load data from.')
     parser.add_argument('--embeddings', default='.embeddings/', type=str, help='where to save embeddings.')
+    parser.add_argument('--vectors_dtype', default='float32', choices=VECTORS_DTYPE_CHOICES, help=VECTORS_DTYPE_HELP)
+    parser.add_argument('--vectors_on_device', action='store_true', help=VECTORS_ON_DEVICE_HELP)
     parser.add_argument('--checkpoint_name', default='best.pth',
                         help='Checkpoint file to use (relative to --path, defaults to best.pth)')
+    parser.add_argument('--no_vocab_embeddings', action='store_false', dest='vocab_embeddings',
+                        help='ignore the vocabulary-restricted word vectors saved by `genienlp export --vocab_embeddings`, '
+                             'and load the full word vectors instead')
+    parser.add_argument('--no_vocab_embeddings_fallback', action='store_false', dest='vocab_embeddings_fallback',
+                        help='when using vocabulary-restricted word vectors, treat words outside the exported vocabulary '
+                             'as unknown instead of loading the full word vectors to look them up')
     parser.add_argument('--bleu', action='store_true', help='whether to use the bleu metric (always on for iwslt)')
     parser.add_argument('--rouge', action='store_true',
                         help='whether to use the bleu metric (always on for cnn, dailymail, and cnn_dailymail)')
@@ -237,6 +275,8 @@ def parse_argv(parser):
                         help='whether use exisiting cached splits or generate new ones')
     parser.add_argument('--eval_dir', type=str, required=True, help='use this directory to store eval results')
     parser.add_argument('--cache', default='.cache', type=str, help='where to save cached files')
+    parser.add_argument('--numericalized_cache', action='store_true',
+                        help='Cache the token ids of the preprocessed examples as memory-mapped arrays')
 
     parser.add_argument('--saved_models', default='./saved_models', type=str,
                         help='directory where cached models should be loaded from')
@@ -29,16 +29,29 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import array
 import asyncio
 import json
 import logging
+import math
+import os
+import queue
+import signal
+import socket
+import struct
 import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pprint import pformat
 
 import torch
 
 from . import models
-from .data_utils.embeddings import load_embeddings
+from .data_utils.embeddings import load_embeddings, VOCAB_EMBEDDINGS_DIR, VECTORS_DTYPE_CHOICES, VECTORS_DTYPE_HELP, \
+    VECTORS_ON_DEVICE_HELP
 from .data_utils.example import Batch
 from .tasks.generic_dataset import Example
 from .tasks.registry import get_tasks
@@ -47,6 +60,142 @@ from .validate import generate_with_model
 
 logger = logging.getLogger(__name__)
 
+GENERATION_HYPERPARAMETERS = ['num_outputs', 'temperature', 'top_k', 'top_p', 'repetition_penalty', 'num_beams',
+                              'no_repeat_ngram_size', 'max_output_length']
+# maximum size in bytes of the unprocessed input passed along with a client connection handed off to another worker
+HANDOFF_MAX_SIZE = 1024 * 1024
+
+
+class RequestTimeoutError(Exception):
+    """The request expired before the model could process it"""
+    pass
+
+
+class ResponseCache:
+    """An LRU cache of answers, with optional expiration of old entries"""
+
+    def __init__(self, max_size, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        if key is None or self.max_size <= 0:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        answer, timestamp = entry
+        if self.ttl > 0 and time.time() - timestamp > self.ttl:
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return answer
+
+    def put(self, key, answer):
+        if key is None or self.max_size <= 0:
+            return
+
+        self._entries[key] = (answer, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return dict(size=len(self._entries), max_size=self.max_size, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, expirations=self.expirations)
+
+
+class ServerStats:
+    """Rolling latency histograms for each stage of request processing, and throughput counters"""
+
+    STAGES = ['parse', 'tokenize', 'numericalize', 'encoder', 'decoder', 'generate', 'reverse', 'request']
+    COUNTERS = ['requests', 'batches', 'input_tokens', 'decoder_steps', 'rejected', 'timed_out', 'failed']
+
+    def __init__(self, window=1000):
+        # stages are timed both on the event loop and on the inference thread
+        self._lock = threading.Lock()
+        self._latencies = {stage: deque(maxlen=window) for stage in self.STAGES}
+        self._counters = {counter: 0 for counter in self.COUNTERS}
+        self._start_time = time.time()
+
+    def add_latency(self, stage, seconds):
+        with self._lock:
+            self._latencies[stage].append(seconds)
+
+    def increment(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] += value
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_latency(stage, time.perf_counter() - start)
+
+    def summary(self):
+        with self._lock:
+            latencies = {stage: sorted(values) for stage, values in self._latencies.items() if values}
+            counters = dict(self._counters)
+        uptime = time.time() - self._start_time
+
+        latency_ms = dict()
+        for stage, values in latencies.items():
+            # nearest-rank percentiles
+            latency_ms[stage] = {f'p{p}': 1000 * values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+                                 for p in (50, 95, 99)}
+        throughput = {f'{counter}_per_second': counters[counter] / uptime for counter in self.COUNTERS}
+        return dict(uptime=uptime, counters=counters, throughput=throughput, latency_ms=latency_ms)
+
+    def format_summary(self):
+        summary = self.summary()
+        latency = ', '.join(f'{stage} {values["p50"]:.1f}/{values["p95"]:.1f}/{values["p99"]:.1f}'
+                            for stage, values in summary['latency_ms'].items())
+        throughput = summary['throughput']
+        return f'{throughput["requests_per_second"]:.2f} requests/s, {throughput["batches_per_second"]:.2f} batches/s, ' \
+               f'{throughput["input_tokens_per_second"]:.1f} tokens/s; latency p50/p95/p99 (ms): {latency}'
+
+
+class TimedNumericalizer:
+    """Wrap a numericalizer to time the calls to reverse() made by generate_with_model"""
+
+    def __init__(self, numericalizer, stats):
+        self._numericalizer = numericalizer
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._numericalizer, name)
+
+    def reverse(self, *args, **kwargs):
+        with self._stats.timer('reverse'):
+            return self._numericalizer.reverse(*args, **kwargs)
+
+
+class ClientConnection:
+    """A client connection of the TCP server, which is busy while one of its requests is being answered"""
+    __slots__ = ('reader', 'writer', 'busy', 'handed_off')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.busy = False
+        # passed to another worker, which answers the input that is left
+        self.handed_off = False
+
 
 class Server:
     def __init__(self, args, numericalizer, embeddings, model, device):
@@ -59,27 +208,75 @@ class Server:
         self._embeddings = embeddings
 
         self._cached_tasks = dict()
+        self._request_queue = None
+        # number of requests queued or running on the model, in TCP mode
+        self._in_flight = 0
+        # open client connections in TCP mode, by the task that serves them
+        self._connections = dict()
+        # in prefork mode, a datagram socket pair shared by all the workers, over which retiring workers
+        # pass their client connections to the workers that replace them
+        self._handoff_sockets = None
+        # in prefork mode, the parent process does not run the model: the workers warm up after they are forked
+        self._prefork = False
+        self._ready_pipe = None
+        self._next_worker_id = 0
+        # the model and the numericalizer are not thread-safe, so all inference
+        # runs on a single dedicated thread, off the event loop
+        self._executor = None
+
+        self._response_cache = ResponseCache(args.cache_size, args.cache_ttl)
+        self._checkpoint_id = get_checkpoint_id(args)
+
+        self._stats = ServerStats()
+        self._last_stats_log = time.time()
+        self._instrument_model(model)
+
+        # a new model that was loaded in the background, and will replace the current model before the next batch
+        self._reloaded_model = None
+        self._reload_lock = threading.Lock()
+        self._reload_requested = threading.Event()
+
+    def _instrument_model(self, model):
+        # time the encoder and each decoding step using forward hooks, so we don't need to
+        # modify the model's generate() method
+        def timing_hooks(stage, counter=None):
+            start_time = []
 
-    def numericalize_example(self, ex):
-        new_words = self.numericalizer.grow_vocab([ex])
-        for emb in self._embeddings:
-            emb.grow_for_vocab(self.numericalizer.vocab, new_words)
+            def pre_hook(module, input):
+                start_time.append(time.perf_counter())
 
-        # batch of size 1
-        return Batch.from_examples([ex], self.numericalizer, device=self.device,
+            def hook(module, input, output):
+                self._stats.add_latency(stage, time.perf_counter() - start_time.pop())
+                if counter is not None:
+                    self._stats.increment(counter)
+            return pre_hook, hook
+
+        for module, stage, counter in ((model.encoder, 'encoder', None), (model.decoder, 'decoder', 'decoder_steps')):
+            pre_hook, hook = timing_hooks(stage, counter)
+            module.register_forward_pre_hook(pre_hook)
+            module.register_forward_hook(hook)
+
+    def numericalize_examples(self, examples, numericalizer, embeddings):
+        new_words = numericalizer.grow_vocab(examples)
+        for emb in embeddings:
+            emb.grow_for_vocab(numericalizer.vocab, new_words)
+
+        return Batch.from_examples(examples, numericalizer, device=self.device,
                                    append_question_to_context_too=self.args.append_question_to_context_too,
                                    override_question=self.args.override_question,
                                    override_context=self.args.override_context)
 
-    def handle_request(self, line):
-        request = json.loads(line)
-
-        task_name = request['task'] if 'task' in request else 'generic'
+    def get_task(self, task_name):
         if task_name in self._cached_tasks:
             task = self._cached_tasks[task_name]
         else:
             task = get_tasks([task_name], self.args)[0]
             self._cached_tasks[task_name] = task
+        return task
+
+    def parse_request(self, request):
+        task_name = request['task'] if 'task' in request else 'generic'
+        task = self.get_task(task_name)
 
         context = request['context']
         if not context:
@@ -87,22 +284,322 @@ class Server:
         question = request['question']
         if not question:
             question = task.default_question
+        return task, context, question
+
+    def make_example(self, request, task, context, question):
         answer = ''
+        with self._stats.timer('tokenize'):
+            return Example.from_raw(str(request['id']), context, question, answer, tokenize=task.tokenize,
+                                    lower=self.args.lower)
 
-        ex = Example.from_raw(str(request['id']), context, question, answer, tokenize=task.tokenize,
-                              lower=self.args.lower)
+    def response_cache_key(self, task, context, question):
+        # sampled answers are expected to vary, so they should not be replayed from the cache
+        if any(temperature > 0 for temperature in self.args.temperature):
+            return None
+        hyperparameters = tuple(str(getattr(self.args, h)) for h in GENERATION_HYPERPARAMETERS)
+        return task.name, ' '.join(context.split()), ' '.join(question.split()), hyperparameters, \
+            self._latest_checkpoint_id()
 
-        batch = self.numericalize_example(ex)
-        predictions = generate_with_model(self.model, [batch], self.numericalizer, task, self.args, prediction_file_name=None, output_predictions_only=True)
+    def get_stats(self):
+        stats = self._stats.summary()
+        stats['response_cache'] = self._response_cache.stats()
+        return stats
 
-        response = json.dumps(dict(id=request['id'], answer=predictions[0][0]))
+    def _finish_request(self, start_time):
+        self._stats.increment('requests')
+        self._stats.add_latency('request', time.perf_counter() - start_time)
+
+        if self.args.stats_interval > 0 and time.time() - self._last_stats_log >= self.args.stats_interval:
+            self._last_stats_log = time.time()
+            logger.info(f'Server stats: {self._stats.format_summary()}')
+
+    def handle_command(self, request):
+        command = request['command']
+        if command == 'stats':
+            response = json.dumps(dict(id=request.get('id'), stats=self.get_stats()))
+        else:
+            response = json.dumps(dict(id=request.get('id'), error=f'Invalid command {command}'))
         return response + '\n'
 
+    def _predict(self, model, numericalizer, embeddings, task, examples, stats):
+        # no_grad is thread-local, so we need it here as well as in run()
+        with torch.no_grad():
+            with stats.timer('numericalize'):
+                batch = self.numericalize_examples(examples, numericalizer, embeddings)
+            stats.increment('batches')
+            stats.increment('input_tokens', int(batch.context.length.sum()) + int(batch.question.length.sum()))
+
+            with stats.timer('generate'):
+                predictions = generate_with_model(model, [batch], TimedNumericalizer(numericalizer, stats),
+                                                  task, self.args, prediction_file_name=None,
+                                                  output_predictions_only=True)
+        return [prediction[0] for prediction in predictions]
+
+    def predict(self, task, examples):
+        # predict is only called between batches, so this is the time to switch to a reloaded model
+        self._swap_reloaded_model()
+        return self._predict(self.model, self.numericalizer, self._embeddings, task, examples, self._stats)
+
+    def _latest_checkpoint_id(self):
+        # if a reloaded model is waiting to be swapped in, the next batch will use it
+        with self._reload_lock:
+            if self._reloaded_model is not None:
+                return self._reloaded_model[3]
+            return self._checkpoint_id
+
+    def _swap_reloaded_model(self):
+        with self._reload_lock:
+            reloaded_model = self._reloaded_model
+            self._reloaded_model = None
+        if reloaded_model is None:
+            return
+
+        # old answers will not be returned from the response cache, because the checkpoint id is part of the key
+        self.numericalizer, self._embeddings, self.model, self._checkpoint_id = reloaded_model
+        self._instrument_model(self.model)
+        logger.info(f'Switched to the new model from {self.args.best_checkpoint}')
+
+    def _reload_model(self):
+        checkpoint_id = get_checkpoint_id(self.args)
+        logger.info(f'Reloading the model from {self.args.best_checkpoint}')
+        numericalizer, embeddings, model = load_model(self.args, self.device)
+        model.to(self.device)
+        model.eval()
+        if not self._prefork:
+            self._warmup(model, numericalizer, embeddings, list(self._cached_tasks.keys()) or ['generic'])
+
+        with self._reload_lock:
+            self._reloaded_model = (numericalizer, embeddings, model, checkpoint_id)
+
+    def _watch_checkpoint(self):
+        while True:
+            self._reload_requested.wait(timeout=self.args.reload_interval if self.args.reload_interval > 0 else None)
+            forced = self._reload_requested.is_set()
+            self._reload_requested.clear()
+
+            try:
+                if forced or get_checkpoint_id(self.args) != self._latest_checkpoint_id():
+                    self._reload_model()
+            except Exception:
+                # keep serving with the current model; we will try again at the next change or signal
+                logger.exception(f'Failed to reload the model from {self.args.best_checkpoint}')
+
+    def start_reload_watcher(self):
+        """Reload the model in the background when the checkpoint changes, or when the server receives SIGHUP"""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, lambda signum, frame: self._reload_requested.set())
+        watcher = threading.Thread(target=self._watch_checkpoint, daemon=True)
+        watcher.start()
+
+    def format_response(self, request, answer):
+        response = json.dumps(dict(id=request['id'], answer=answer))
+        return response + '\n'
+
+    def format_error(self, request, error, message=None):
+        response = dict(id=request.get('id'), error=error)
+        if message is not None:
+            response['message'] = message
+        return json.dumps(response) + '\n'
+
+    def format_failure(self, request, exception):
+        """Log a request that failed, and answer it with an error, instead of failing the other requests with it"""
+        logger.error('Failed to handle request', exc_info=exception)
+        self._stats.increment('failed')
+        return self.format_error(request if isinstance(request, dict) else dict(), 'failed',
+                                 f'{type(exception).__name__}: {exception}')
+
+    def handle_requests(self, lines):
+        """
+        Answer a list of requests, batching together the requests for the same task.
+        Responses are returned in the same order as the requests. A request that fails is answered with an error,
+        and does not fail the other requests.
+        """
+        responses = [None] * len(lines)
+        groups = OrderedDict()
+        for i, line in enumerate(lines):
+            start_time = time.perf_counter()
+            request = None
+            try:
+                with self._stats.timer('parse'):
+                    request = json.loads(line)
+                if 'command' in request:
+                    responses[i] = self.handle_command(request)
+                    continue
+
+                task, context, question = self.parse_request(request)
+                cache_key = self.response_cache_key(task, context, question)
+                answer = self._response_cache.get(cache_key)
+                if answer is not None:
+                    self._finish_request(start_time)
+                    responses[i] = self.format_response(request, answer)
+                    continue
+
+                ex = self.make_example(request, task, context, question)
+            except Exception as e:
+                responses[i] = self.format_failure(request, e)
+                continue
+            groups.setdefault(task.name, []).append((i, request, task, ex, cache_key, start_time))
+
+        for group in groups.values():
+            self._predict_requests(group, responses)
+        return responses
+
+    def _predict_requests(self, group, responses):
+        task = group[0][2]
+        try:
+            answers = self.predict(task, [ex for _, _, _, ex, _, _ in group])
+        except Exception as e:
+            if len(group) == 1:
+                i, request, _, _, _, _ = group[0]
+                responses[i] = self.format_failure(request, e)
+                return
+            # predict each request on its own, so that one bad input does not fail the requests batched with it
+            logger.warning(f'Batch of {len(group)} requests failed ({type(e).__name__}: {e}), retrying them one by one')
+            for request in group:
+                self._predict_requests([request], responses)
+            return
+        for (i, request, _, _, cache_key, start_time), answer in zip(group, answers):
+            self._response_cache.put(cache_key, answer)
+            self._finish_request(start_time)
+            responses[i] = self.format_response(request, answer)
+
+    def handle_request(self, line):
+        return self.handle_requests([line])[0]
+
+    async def handle_request_async(self, line):
+        start_time = time.perf_counter()
+        request = None
+        try:
+            with self._stats.timer('parse'):
+                request = json.loads(line)
+            return await self._handle_request_async(request, start_time)
+        except Exception as e:
+            # answer with an error instead of dropping the connection, which would also drop
+            # the responses to the other requests of this client
+            return self.format_failure(request, e)
+
+    async def _handle_request_async(self, request, start_time):
+        if 'command' in request:
+            return self.handle_command(request)
+
+        task, context, question = self.parse_request(request)
+        cache_key = self.response_cache_key(task, context, question)
+        answer = self._response_cache.get(cache_key)
+        if answer is None:
+            # admission control: fail fast rather than letting latency grow for everyone
+            if (self.args.max_in_flight > 0 and self._in_flight >= self.args.max_in_flight) or \
+                    (self.args.max_queue_size > 0 and self._request_queue.qsize() >= self.args.max_queue_size):
+                self._stats.increment('rejected')
+                return self.format_error(request, 'overloaded')
+
+            # the client can override the default deadline
+            timeout = request.get('timeout', self.args.request_timeout)
+            try:
+                timeout = float(timeout)
+            except (TypeError, ValueError):
+                timeout = math.nan
+            if not math.isfinite(timeout):
+                return self.format_error(request, 'invalid',
+                                         f'timeout must be a number of seconds, not {request.get("timeout")!r}')
+            loop = asyncio.get_event_loop()
+            deadline = loop.time() + timeout if timeout > 0 else None
+
+            ex = self.make_example(request, task, context, question)
+            future = loop.create_future()
+            self._in_flight += 1
+            try:
+                await self._request_queue.put((task, ex, future, deadline))
+                if deadline is None:
+                    answer = await future
+                else:
+                    # answer when the deadline passes, even if the request is still queued or running;
+                    # the batcher skips the requests whose future was cancelled
+                    answer = await asyncio.wait_for(future, max(0, deadline - loop.time()))
+            except (RequestTimeoutError, asyncio.TimeoutError):
+                self._stats.increment('timed_out')
+                return self.format_error(request, 'timeout')
+            finally:
+                self._in_flight -= 1
+            self._response_cache.put(cache_key, answer)
+        self._finish_request(start_time)
+        return self.format_response(request, answer)
+
+    async def _next_micro_batch(self):
+        """Wait for at least one request, then collect more until the batch is full or the wait window expires"""
+        loop = asyncio.get_event_loop()
+        pending = [await self._request_queue.get()]
+        deadline = loop.time() + self.args.max_batch_wait
+        while len(pending) < self.args.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(self._request_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return pending
+
+    async def _run_batcher(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            pending = await self._next_micro_batch()
+
+            # generation hyperparameters are global to the server, so requests are
+            # compatible (and can share a batch) if they are for the same task
+            groups = OrderedDict()
+            for task, ex, future, deadline in pending:
+                groups.setdefault(task.name, []).append((task, ex, future, deadline))
+
+            for group in groups.values():
+                # drop the requests whose client has already given up on them
+                now = loop.time()
+                live_group = []
+                for task, ex, future, deadline in group:
+                    if future.done():
+                        continue
+                    if deadline is not None and now > deadline:
+                        future.set_exception(RequestTimeoutError())
+                        continue
+                    live_group.append((task, ex, future))
+                if not live_group:
+                    continue
+
+                await self._predict_group(live_group)
+
+    async def _predict_group(self, group):
+        # the requests that timed out while we were retrying are not needed anymore
+        group = [request for request in group if not request[2].done()]
+        if not group:
+            return
+        loop = asyncio.get_event_loop()
+        task = group[0][0]
+        try:
+            answers = await loop.run_in_executor(self._executor, self.predict, task, [ex for _, ex, _ in group])
+        except Exception as e:
+            if len(group) == 1:
+                _, _, future = group[0]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # predict each request on its own, so that one bad input does not fail the requests batched with it
+            logger.warning(f'Batch of {len(group)} requests failed ({type(e).__name__}: {e}), retrying them one by one')
+            for request in group:
+                await self._predict_group([request])
+            return
+        for (_, _, future), answer in zip(group, answers):
+            if not future.done():
+                future.set_result(answer)
+
     async def handle_client(self, client_reader, client_writer):
+        task = asyncio.current_task()
+        connection = ClientConnection(client_reader, client_writer)
+        self._connections[task] = connection
         try:
             line = await client_reader.readline()
-            while line:
-                client_writer.write(self.handle_request(line).encode('utf-8'))
+            while line and not connection.handed_off:
+                connection.busy = True
+                client_writer.write((await self.handle_request_async(line)).encode('utf-8'))
+                connection.busy = False
                 line = await client_reader.readline()
 
         except IOError:
@@ -111,37 +608,326 @@ class Server:
                 client_writer.close()
             except IOError:
                 pass
+        finally:
+            del self._connections[task]
+
+    def _hand_off_connection(self, connection):
+        """
+        Pass an idle client connection to one of the workers that replace this one, with the input that was
+        received but not processed yet. Returns False if the connection could not be passed yet.
+        """
+        transport = connection.writer.transport
+        transport.pause_reading()
+        # the reader does not expose its buffer; this is the input after the last line we answered
+        pending = bytes(connection.reader._buffer)
+        fd = connection.writer.get_extra_info('socket').fileno()
+        try:
+            self._handoff_sockets[0].sendmsg([pending], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+        except BlockingIOError:
+            # the new workers have not caught up with the connections we passed them
+            transport.resume_reading()
+            return False
+        except OSError:
+            logger.exception('Failed to pass a client connection to a new worker, closing it')
+        # closing our copy of the socket does not close the connection, which is still open in the new worker
+        connection.handed_off = True
+        transport.close()
+        return True
+
+    def _accept_handoff(self):
+        fds = array.array('i')
+        try:
+            data, ancdata, _flags, _address = self._handoff_sockets[1].recvmsg(HANDOFF_MAX_SIZE,
+                                                                               socket.CMSG_SPACE(fds.itemsize))
+        except BlockingIOError:
+            # another worker took the connection
+            return
+        for level, kind, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+        for fd in fds:
+            asyncio.get_event_loop().create_task(self._adopt_connection(socket.socket(fileno=fd), data))
+
+    async def _adopt_connection(self, sock, pending):
+        loop = asyncio.get_event_loop()
+        sock.setblocking(False)
+        reader = asyncio.StreamReader()
+        # the input received by the previous worker goes first
+        reader.feed_data(pending)
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await loop.connect_accepted_socket(lambda: protocol, sock=sock)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        await self.handle_client(reader, writer)
+
+    async def _close_connections(self, handoff=False):
+        """
+        Close the client connections (or pass them to the workers that replace this one, if handoff is true),
+        each one once its request in progress is answered
+        """
+        while self._connections:
+            for connection in list(self._connections.values()):
+                if connection.busy or connection.writer.transport.get_write_buffer_size() > 0:
+                    continue
+                if handoff:
+                    self._hand_off_connection(connection)
+                else:
+                    connection.writer.close()
+            await asyncio.sleep(0.05)
 
-    def _run_tcp(self):
+    async def _drain(self, server, handoff=False):
+        """Stop accepting connections, then stop the event loop once the requests in flight are answered"""
+        server.close()
+        if self._handoff_sockets is not None:
+            asyncio.get_event_loop().remove_reader(self._handoff_sockets[1].fileno())
+        await self._close_connections(handoff)
+        while self._in_flight > 0:
+            await asyncio.sleep(0.1)
+        asyncio.get_event_loop().stop()
+
+    def _run_tcp(self, sock=None):
         loop = asyncio.get_event_loop()
-        server = loop.run_until_complete(asyncio.start_server(self.handle_client, port=self.args.port))
+        self._request_queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        batcher = loop.create_task(self._run_batcher())
+        if sock is not None:
+            # prefork worker: the parent process reloads the model, and retires the workers with SIGUSR1, after
+            # which they pass their client connections to the new workers; SIGTERM stops them
+            server = loop.run_until_complete(asyncio.start_server(self.handle_client, sock=sock))
+            loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(self._drain(server)))
+            loop.add_signal_handler(signal.SIGUSR1, lambda: loop.create_task(self._drain(server, handoff=True)))
+            loop.add_reader(self._handoff_sockets[1].fileno(), self._accept_handoff)
+        else:
+            self.start_reload_watcher()
+            server = loop.run_until_complete(asyncio.start_server(self.handle_client, port=self.args.port))
         try:
             loop.run_forever()
         except KeyboardInterrupt:
-            pass
+            server.close()
+            loop.run_until_complete(self._close_connections())
         server.close()
         loop.run_until_complete(server.wait_closed())
+        batcher.cancel()
+        loop.run_until_complete(asyncio.gather(batcher, return_exceptions=True))
+        self._executor.shutdown(wait=True)
         loop.close()
 
+    def _fork_workers(self, sock, num_threads, num_workers, warmup):
+        worker_pids = []
+        for _ in range(num_workers):
+            worker_id = self._next_worker_id
+            self._next_worker_id += 1
+            pid = os.fork()
+            if pid == 0:
+                exit_code = 0
+                try:
+                    # the reload watcher thread of the parent could have held the lock when we forked
+                    self._reload_lock = threading.Lock()
+                    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                    # until the worker is ready to retire
+                    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+                    torch.set_num_threads(num_threads)
+                    logger.info(f'Worker {worker_id} started with pid {os.getpid()}')
+                    # warm up after forking, because forking after the intra-op thread pool
+                    # has started can hang the children
+                    if warmup:
+                        self.warmup(list(self._cached_tasks.keys()) or ['generic'])
+                    os.write(self._ready_pipe[1], struct.pack('i', os.getpid()))
+                    self._run_tcp(sock)
+                except Exception:
+                    logger.exception(f'Worker {worker_id} failed')
+                    exit_code = 1
+                finally:
+                    os._exit(exit_code)
+            worker_pids.append(pid)
+        return worker_pids
+
+    def _read_ready_workers(self):
+        """The pids of the workers that became ready to serve since the last call"""
+        try:
+            data = os.read(self._ready_pipe[0], 4096)
+        except BlockingIOError:
+            return set()
+        return {pid for pid, in struct.iter_unpack('i', data)}
+
+    def _run_prefork(self):
+        """Fork worker processes that share the model and the word vectors, and serve on the same port
+
+        The model weights are moved to shared memory, and the word vectors are either memory-mapped
+        or shared copy-on-write, so the memory cost of each additional worker is small. Workers that
+        die after they started serving are replaced.
+
+        The model is reloaded by the parent process, which then forks a new set of workers sharing the new
+        model, and retires the old workers once the new ones are warmed up. Reloading in each worker would give
+        every worker its own copy of the model. The old workers answer their requests in flight, then pass their
+        client connections to the new workers, so clients keep their connections and get answers from the new model.
+        """
+        self._prefork = True
+        self.model.share_memory()
+        self._handoff_sockets = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for handoff_socket in self._handoff_sockets:
+            handoff_socket.setblocking(False)
+        # the workers write their pid to this pipe once they are warmed up and ready to serve
+        self._ready_pipe = os.pipe()
+        os.set_blocking(self._ready_pipe[0], False)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.args.port))
+        sock.listen(100)
+        sock.setblocking(False)
+
+        # split the intra-op thread pool among the workers, to avoid oversubscribing the CPU
+        num_threads = max(1, torch.get_num_threads() // self.args.num_workers)
+
+        # the workers forked after a reload always warm up the new model, like _reload_model does otherwise
+        warmup = self.args.warmup
+        worker_pids = set(self._fork_workers(sock, num_threads, self.args.num_workers, warmup))
+        starting_pids = set(worker_pids)
+        # the workers that serve an old model: they are retired once the new workers are ready
+        old_pids = set()
+        retiring_pids = set()
+        stopping = False
+
+        def forward_signal(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in worker_pids | old_pids:
+                try:
+                    os.kill(pid, signum)
+                except OSError:
+                    pass
+        signal.signal(signal.SIGTERM, forward_signal)
+        self.start_reload_watcher()
+
+        while worker_pids or old_pids or retiring_pids:
+            try:
+                with self._reload_lock:
+                    reloaded = self._reloaded_model is not None
+                if reloaded and not stopping:
+                    self._swap_reloaded_model()
+                    self.model.share_memory()
+                    warmup = True
+                    old_pids |= worker_pids
+                    worker_pids = set(self._fork_workers(sock, num_threads, self.args.num_workers, warmup))
+                    starting_pids = set(worker_pids)
+
+                starting_pids -= self._read_ready_workers()
+                if old_pids and not starting_pids:
+                    for pid in old_pids:
+                        try:
+                            os.kill(pid, signal.SIGUSR1)
+                        except OSError:
+                            pass
+                    retiring_pids |= old_pids
+                    old_pids = set()
+
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid == 0:
+                    time.sleep(0.5)
+                    continue
+                if pid in worker_pids:
+                    worker_pids.discard(pid)
+                    if pid in starting_pids:
+                        # do not replace the workers that fail while starting, they would most likely fail again
+                        starting_pids.discard(pid)
+                        logger.error(f'Worker with pid {pid} failed to start (status {status})')
+                    elif not stopping:
+                        logger.warning(f'Worker with pid {pid} exited unexpectedly (status {status}), replacing it')
+                        new_pids = self._fork_workers(sock, num_threads, 1, warmup)
+                        worker_pids.update(new_pids)
+                        starting_pids.update(new_pids)
+                old_pids.discard(pid)
+                retiring_pids.discard(pid)
+            except KeyboardInterrupt:
+                # the workers received the same SIGINT, wait for them to shut down
+                stopping = True
+        sock.close()
+        for handoff_socket in self._handoff_sockets:
+            handoff_socket.close()
+        for fd in self._ready_pipe:
+            os.close(fd)
+
     def _run_stdin(self):
+        # read stdin on a separate thread, so we can batch together all the lines that are
+        # already available without blocking interactive callers waiting for a response
+        lines = queue.Queue(maxsize=4 * self.args.max_batch_size)
+
+        def read_lines():
+            for line in sys.stdin:
+                lines.put(line)
+            lines.put(None)
+        reader = threading.Thread(target=read_lines, daemon=True)
+        reader.start()
+        self.start_reload_watcher()
+
         try:
-            while True:
-                line = sys.stdin.readline()
-                if not line:
+            eof = False
+            while not eof:
+                line = lines.get()
+                if line is None:
                     break
-                sys.stdout.write(self.handle_request(line))
+                batch = [line]
+                deadline = time.time() + self.args.max_batch_wait
+                while len(batch) < self.args.max_batch_size:
+                    try:
+                        line = lines.get(timeout=max(0, deadline - time.time()))
+                    except queue.Empty:
+                        break
+                    if line is None:
+                        eof = True
+                        break
+                    batch.append(line)
+
+                for response in self.handle_requests(batch):
+                    sys.stdout.write(response)
                 sys.stdout.flush()
         except KeyboardInterrupt:
             pass
 
+    def _warmup(self, model, numericalizer, embeddings, task_names):
+        """
+        Run synthetic batches of a few different sizes through the model, so that the first real requests
+        do not pay for lazy initialization (memory allocation, kernel selection, etc.)
+        """
+        # do not count the warmup in the server statistics
+        stats = ServerStats()
+        start_time = time.time()
+        for task_name in task_names:
+            task = self.get_task(task_name)
+            for length in (4, 16, 64):
+                context = ' '.join(['hello'] * length)
+                for batch_size in sorted({1, self.args.max_batch_size}):
+                    examples = [Example.from_raw(f'warmup-{i}', context, task.default_question, '',
+                                                 tokenize=task.tokenize, lower=self.args.lower)
+                                for i in range(batch_size)]
+                    self._predict(model, numericalizer, embeddings, task, examples, stats)
+        logger.info(f'Warmed up the model in {time.time() - start_time:.2f} seconds')
+
+    def warmup(self, task_names):
+        self._warmup(self.model, self.numericalizer, self._embeddings, task_names)
+        # the timing hooks on the model recorded the warmup batches, and the uptime includes the warmup too
+        self._stats = ServerStats()
+
     def run(self):
         log_model_size(logger, self.model, self.args.model)
         self.model.to(self.device)
 
         self.model.eval()
         with torch.no_grad():
+            for task_name in self.args.preload_tasks:
+                self.get_task(task_name)
+            prefork = not self.args.stdin and self.args.num_workers > 1
+            # in prefork mode, each worker warms up after it is forked
+            if self.args.warmup and not prefork:
+                self.warmup(self.args.preload_tasks or ['generic'])
+
             if self.args.stdin:
                 self._run_stdin()
+            elif prefork:
+                self._run_prefork()
             else:
                 self._run_tcp()
 
@@ -152,27 +938,75 @@ def parse_argv(parser):
                         help='a list of devices that can be used (multi-gpu currently WIP)')
     parser.add_argument('--seed', default=123, type=int, help='Random seed.')
     parser.add_argument('--embeddings', default='.embeddings', type=str, help='where to save embeddings.')
+    parser.add_argument('--vectors_dtype', default='float32', choices=VECTORS_DTYPE_CHOICES, help=VECTORS_DTYPE_HELP)
+    parser.add_argument('--vectors_on_device', action='store_true', help=VECTORS_ON_DEVICE_HELP)
     parser.add_argument('--checkpoint_name', default='best.pth',
                         help='Checkpoint file to use (relative to --path, defaults to best.pth)')
     parser.add_argument('--port', default=8401, type=int, help='TCP port to listen on')
     parser.add_argument('--stdin', action='store_true', help='Interact on stdin/stdout instead of TCP')
+    parser.add_argument('--max_batch_size', default=16, type=int,
+                        help='maximum number of concurrent requests (or stdin lines) to batch together')
+    parser.add_argument('--max_batch_wait', default=0.01, type=float,
+                        help='maximum time (in seconds) to wait for more requests before running a batch')
+    parser.add_argument('--num_workers', default=1, type=int,
+                        help='number of worker processes to fork in TCP mode; workers share the model and the '
+                             'word vectors, and listen on the same port (CPU only)')
+    parser.add_argument('--max_in_flight', default=0, type=int,
+                        help='maximum number of requests waiting for or running on the model in each worker; '
+                             'requests over the limit receive an "overloaded" error (0 means no limit)')
+    parser.add_argument('--max_queue_size', default=0, type=int,
+                        help='maximum number of requests waiting to be batched in each worker; requests over the '
+                             'limit receive an "overloaded" error (0 means no limit)')
+    parser.add_argument('--request_timeout', default=0, type=float,
+                        help='default deadline (in seconds) for a request; requests that are still waiting after '
+                             'the deadline receive a "timeout" error instead of an answer (0 means no deadline); '
+                             'can be overridden with the "timeout" field of the request')
+    parser.add_argument('--cache_size', default=10000, type=int,
+                        help='maximum number of answers to keep in the response cache (0 disables the cache)')
+    parser.add_argument('--cache_ttl', default=0, type=float,
+                        help='time (in seconds) after which a cached answer expires (0 means answers never expire)')
+    parser.add_argument('--preload_tasks', default=[], nargs='+', type=str,
+                        help='tasks to load at startup, instead of when the first request for them arrives')
+    parser.add_argument('--warmup', action='store_true',
+                        help='run a few synthetic batches through the model for each preloaded task (or the generic '
+                             'task) before accepting requests')
+    parser.add_argument('--stats_interval', default=300, type=float,
+                        help='how often (in seconds) to log latency and throughput statistics (0 disables logging); '
+                             'statistics are also available with the "stats" command')
+    parser.add_argument('--reload_interval', default=0, type=float,
+                        help='how often (in seconds) to check the checkpoint for changes, and reload the model if it '
+                             'changed (0 disables polling; the model can still be reloaded by sending SIGHUP)')
+    parser.add_argument('--max_oov_words', default=10000, type=int,
+                        help='maximum number of out-of-vocabulary words to keep in the vocabulary; least recently '
+                             'used words are replaced after this limit is reached (0 means no limit)')
+    parser.add_argument('--no_vocab_embeddings', action='store_false', dest='vocab_embeddings',
+                        help='ignore the vocabulary-restricted word vectors saved by `genienlp export --vocab_embeddings`, '
+                             'and load the full word vectors instead')
+    parser.add_argument('--no_vocab_embeddings_fallback', action='store_false', dest='vocab_embeddings_fallback',
+                        help='when using vocabulary-restricted word vectors, treat words outside the exported vocabulary '
+                             'as unknown instead of loading the full word vectors to look them up')
 
 
-def main(args):
-    load_config_json(args)
-    set_seed(args)
+def get_checkpoint_id(args):
+    # identify the checkpoint by path and modification time, so that a new checkpoint
+    # saved at the same path does not reuse the old answers
+    return args.best_checkpoint, os.stat(args.best_checkpoint).st_mtime_ns
 
-    logger.info(f'Arguments:\n{pformat(vars(args))}')
-    logger.info(f'Loading from {args.best_checkpoint}')
 
-    devices = init_devices(args)
-    save_dict = torch.load(args.best_checkpoint, map_location=devices[0])
+def load_model(args, device):
+    save_dict = torch.load(args.best_checkpoint, map_location=device)
 
     numericalizer, context_embeddings, question_embeddings, decoder_embeddings = \
         load_embeddings(args.embeddings, args.context_embeddings, args.question_embeddings,
-                        args.decoder_embeddings, args.max_generative_vocab)
+                        args.decoder_embeddings, args.max_generative_vocab,
+                        vocab_embeddings_dir=os.path.join(args.path, VOCAB_EMBEDDINGS_DIR) if args.vocab_embeddings else None,
+                        vocab_embeddings_fallback=args.vocab_embeddings_fallback,
+                        vectors_dtype=args.vectors_dtype, vectors_on_device=args.vectors_on_device)
     numericalizer.load(args.path)
-    for emb in set(context_embeddings + question_embeddings + decoder_embeddings):
+    if args.max_oov_words > 0:
+        numericalizer.set_max_oov_words(args.max_oov_words)
+    embeddings = list(set(context_embeddings + question_embeddings + decoder_embeddings))
+    for emb in embeddings:
         emb.init_for_vocab(numericalizer.vocab)
 
     logger.info(f'Initializing Model')
@@ -181,7 +1015,21 @@ def main(args):
     model_dict = save_dict['model_state_dict']
     model.load_state_dict(model_dict)
 
-    server = Server(args, numericalizer, context_embeddings + question_embeddings + decoder_embeddings,
-                    model, devices[0])
+    return numericalizer, embeddings, model
+
+
+def main(args):
+    load_config_json(args)
+    set_seed(args)
+
+    logger.info(f'Arguments:\n{pformat(vars(args))}')
+    logger.info(f'Loading from {args.best_checkpoint}')
+
+    devices = init_devices(args)
+    if args.num_workers > 1 and devices[0].type != 'cpu':
+        raise ValueError('Multiple server workers are only supported when running on CPU')
+
+    numericalizer, embeddings, model = load_model(args, devices[0])
+    server = Server(args, numericalizer, embeddings, model, devices[0])
 
     server.run()
@@ -46,8 +46,8 @@ from . import arguments
 from . import models
 from .data_utils.embeddings import load_embeddings
 from .data_utils.example import Example
-from .util import elapsed_time, set_seed, preprocess_examples, get_trainable_params, make_data_loader,\
-    log_model_size, init_devices
+from .util import elapsed_time, set_seed, preprocess_examples, load_numericalized_splits, get_trainable_params, \
+    make_data_loader, log_model_size, init_devices
 from .model_utils.parallel_utils import NamedTupleCompatibleDataParallel
 from .model_utils.saver import Saver
 from .validate import validate
@@ -72,63 +72,153 @@ def initialize_logger(args):
     return logger
 
 
-def prepare_data(args, logger):
-    train_sets, val_sets, aux_sets, vocab_sets = [], [], [], []
+def get_train_split_kwargs(args, task):
+    kwargs = {'test': None, 'validation': None}
+    kwargs.update({'subsample': args.subsample, 'skip_cache': args.skip_cache, 'cache_input_data': args.cache_input_data,
+                   'cached_path': os.path.join(args.cache, task.name), 'all_dirs': args.train_languages,
+                   'sentence_batching': args.sentence_batching, 'almond_lang_as_question': args.almond_lang_as_question})
+    if args.use_curriculum:
+        kwargs['curriculum'] = True
+    return kwargs
+
+
+def get_val_split_kwargs(args, task):
+    kwargs = {'train': None, 'test': None}
+    # choose best model based on this dev set
+    if args.eval_set_name is not None:
+        kwargs['validation'] = args.eval_set_name
+    kwargs.update({'subsample': args.subsample, 'skip_cache': args.skip_cache, 'cache_input_data': args.cache_input_data,
+                   'cached_path': os.path.join(args.cache, task.name), 'all_dirs': args.eval_languages,
+                    'almond_lang_as_question': args.almond_lang_as_question})
+    return kwargs
+
+
+def load_train_split(args, task, kwargs, logger):
+    logger.info(f'Adding {task.name} to training datasets')
+    split = task.get_splits(args.data, lower=args.lower, **kwargs)
+    assert not split.eval and not split.test
+    if args.use_curriculum:
+        assert split.aux
+        logger.info(f'{task.name} has {len(split.aux)} auxiliary examples')
+    else:
+        assert split.train
+    logger.info(f'{task.name} has {len(split.train)} training examples')
+    return split
+
+
+def load_val_split(args, task, kwargs, logger):
+    logger.info(f'Adding {task.name} to validation datasets')
+    split = task.get_splits(args.data, lower=args.lower, **kwargs)
+    assert not split.train and not split.test and not split.aux
+    logger.info(f'{task.name} has {len(split.eval)} validation examples')
+    return split
+
+
+def load_numericalized_data(args, numericalizer, logger):
+    """
+    Load the training, validation and auxiliary sets from the numericalized cache, or load, preprocess and cache them.
+
+    The vocabulary must be known beforehand, so the data files are only read on a cache miss.
+    """
+    train_sets, val_sets, aux_sets = [], [], []
     for task in args.train_tasks:
         logger.info(f'Loading {task.name}')
-        kwargs = {'test': None, 'validation': None}
-        kwargs.update({'subsample': args.subsample, 'skip_cache': args.skip_cache, 'cache_input_data': args.cache_input_data,
-                       'cached_path': os.path.join(args.cache, task.name), 'all_dirs': args.train_languages,
-                       'sentence_batching': args.sentence_batching, 'almond_lang_as_question': args.almond_lang_as_question})
-        if args.use_curriculum:
-            kwargs['curriculum'] = True
+        kwargs = get_train_split_kwargs(args, task)
 
-        logger.info(f'Adding {task.name} to training datasets')
-        split = task.get_splits(args.data, lower=args.lower, **kwargs)
-        assert not split.eval and not split.test
+        def load_splits():
+            split = load_train_split(args, task, kwargs, logger)
+            if args.use_curriculum:
+                logger.info('Preprocessing auxiliary data for curriculum')
+                preprocess_examples(args, [task], [split.aux], logger, train=True)
+            logger.info('Preprocessing training data')
+            preprocess_examples(args, [task], [split.train], logger, train=True)
+            return [split.train, split.aux if args.use_curriculum else None]
+
+        (train_set, aux_set), _ = load_numericalized_splits(args, task, kwargs, load_splits, numericalizer, train=True,
+                                                            logger=logger)
+        train_sets.append(train_set)
         if args.use_curriculum:
-            assert split.aux
-            aux_sets.append(split.aux)
-            logger.info(f'{task.name} has {len(split.aux)} auxiliary examples')
-        else:
-            assert split.train
-        train_sets.append(split.train)
-        logger.info(f'{task.name} has {len(split.train)} training examples')
-        if args.vocab_tasks is not None and task.name in args.vocab_tasks:
-            vocab_sets.extend(split)
+            aux_sets.append(aux_set)
 
     for task in args.val_tasks:
         logger.info(f'Loading {task.name}')
-        kwargs = {'train': None, 'test': None}
-        # choose best model based on this dev set
-        if args.eval_set_name is not None:
-            kwargs['validation'] = args.eval_set_name
-        kwargs.update({'subsample': args.subsample, 'skip_cache': args.skip_cache, 'cache_input_data': args.cache_input_data,
-                       'cached_path': os.path.join(args.cache, task.name), 'all_dirs': args.eval_languages,
-                        'almond_lang_as_question': args.almond_lang_as_question})
-        
-        logger.info(f'Adding {task.name} to validation datasets')
-        split = task.get_splits(args.data, lower=args.lower, **kwargs)
-        assert not split.train and not split.test and not split.aux
-        logger.info(f'{task.name} has {len(split.eval)} validation examples')
-        val_sets.append(split.eval)
-        if args.vocab_tasks is not None and task.name in args.vocab_tasks:
-            vocab_sets.extend(split)
+        kwargs = get_val_split_kwargs(args, task)
+
+        def load_splits():
+            split = load_val_split(args, task, kwargs, logger)
+            logger.info('Preprocessing validation data')
+            preprocess_examples(args, [task], [split.eval], logger, train=args.val_filter)
+            return [split.eval]
+
+        (val_set,), _ = load_numericalized_splits(args, task, kwargs, load_splits, numericalizer, train=args.val_filter,
+                                                  logger=logger)
+        val_sets.append(val_set)
 
+    return train_sets, val_sets, aux_sets
+
+
+def prepare_data(args, logger):
     numericalizer, context_embeddings, question_embeddings, decoder_embeddings = \
         load_embeddings(args.embeddings,
                         args.context_embeddings,
                         args.question_embeddings,
                         args.decoder_embeddings,
                         args.max_generative_vocab,
-                        logger)
-    if args.load is not None:
+                        logger,
+                        vectors_dtype=args.vectors_dtype,
+                        vectors_on_device=args.vectors_on_device)
+
+    if args.load is not None and args.numericalized_cache:
+        # the vocabulary does not depend on the data, so the data is only loaded if it is not in the numericalized cache
         numericalizer.load(args.save)
+        train_sets, val_sets, aux_sets = load_numericalized_data(args, numericalizer, logger)
     else:
-        vocab_sets = (train_sets + val_sets) if len(vocab_sets) == 0 else vocab_sets
-        logger.info(f'Building vocabulary')
-        numericalizer.build_vocab(Example.vocab_fields, vocab_sets)
-        numericalizer.save(args.save)
+        train_sets, val_sets, aux_sets, vocab_sets = [], [], [], []
+        for task in args.train_tasks:
+            logger.info(f'Loading {task.name}')
+            split = load_train_split(args, task, get_train_split_kwargs(args, task), logger)
+            if args.use_curriculum:
+                aux_sets.append(split.aux)
+            train_sets.append(split.train)
+            if args.vocab_tasks is not None and task.name in args.vocab_tasks:
+                vocab_sets.extend(split)
+
+        for task in args.val_tasks:
+            logger.info(f'Loading {task.name}')
+            split = load_val_split(args, task, get_val_split_kwargs(args, task), logger)
+            val_sets.append(split.eval)
+            if args.vocab_tasks is not None and task.name in args.vocab_tasks:
+                vocab_sets.extend(split)
+
+        if args.load is not None:
+            numericalizer.load(args.save)
+        else:
+            vocab_sets = (train_sets + val_sets) if len(vocab_sets) == 0 else vocab_sets
+            logger.info(f'Building vocabulary')
+            numericalizer.build_vocab(Example.vocab_fields, vocab_sets)
+            numericalizer.save(args.save)
+
+        if args.use_curriculum:
+            logger.info('Preprocessing auxiliary data for curriculum')
+            preprocess_examples(args, args.train_tasks, aux_sets, logger, train=True)
+        logger.info('Preprocessing training data')
+        preprocess_examples(args, args.train_tasks, train_sets, logger, train=True)
+        logger.info('Preprocessing validation data')
+        preprocess_examples(args, args.val_tasks, val_sets, logger, train=args.val_filter)
+
+        if args.numericalized_cache:
+            logger.info('Numericalizing data')
+            for i, task in enumerate(args.train_tasks):
+                (train_sets[i], aux_set), _ = load_numericalized_splits(
+                    args, task, get_train_split_kwargs(args, task),
+                    lambda: [train_sets[i], aux_sets[i] if args.use_curriculum else None],
+                    numericalizer, train=True, logger=logger)
+                if args.use_curriculum:
+                    aux_sets[i] = aux_set
+            for i, task in enumerate(args.val_tasks):
+                (val_sets[i],), _ = load_numericalized_splits(args, task, get_val_split_kwargs(args, task),
+                                                              lambda: [val_sets[i]], numericalizer,
+                                                              train=args.val_filter, logger=logger)
 
     logger.info(f'Initializing encoder and decoder embeddings')
     for vec in set(context_embeddings + question_embeddings + decoder_embeddings):
@@ -138,14 +228,6 @@ def prepare_data(args, logger):
     logger.debug(f'The first 200 tokens:')
     logger.debug(numericalizer.vocab.itos[:200])
 
-    if args.use_curriculum:
-        logger.info('Preprocessing auxiliary data for curriculum')
-        preprocess_examples(args, args.train_tasks, aux_sets, logger, train=True)
-    logger.info('Preprocessing training data')
-    preprocess_examples(args, args.train_tasks, train_sets, logger, train=True)
-    logger.info('Preprocessing validation data')
-    preprocess_examples(args, args.val_tasks, val_sets, logger, train=args.val_filter)
-
     return numericalizer, context_embeddings, question_embeddings, decoder_embeddings, train_sets, val_sets, aux_sets
 
 accumulated_batch_lengths = 0
@@ -41,6 +41,8 @@ import torch
 
 from .data_utils.example import Batch
 from .data_utils.iterator import Iterator
+from .data_utils.numericalized_examples import NumericalizedExamples
+from .tasks.generic_dataset import CQA
 
 logger = logging.getLogger(__name__)
 
@@ -347,6 +349,89 @@ def preprocess_examples(args, tasks, splits, logger=None, train=True):
                 logger.info('Answer: ' + ' '.join([token.strip() for token in ex.answer]))
 
 
+def task_options(task):
+    """
+    The name of the task and the settings it stores, which affect how it loads and preprocesses examples.
+    """
+    options = {'class': type(task).__module__ + '.' + type(task).__qualname__}
+    for name, value in vars(task).items():
+        if value is None or isinstance(value, (bool, int, float, str, list, tuple)):
+            options[name] = value
+    return sorted(options.items())
+
+
+def load_numericalized_splits(args, task, split_kwargs, load_splits, numericalizer, train=True, grow_vocab=False,
+                              logger=None):
+    """
+    Load the preprocessed datasets of a task from the numericalized cache in args.cache, or load them with
+    load_splits() and cache them.
+
+    The cache is keyed on the files in args.data, the task, the arguments used to load and preprocess the examples
+    (split_kwargs and train), and the vocabulary, so on a hit load_splits is not called at all. Either way, the
+    examples of the returned datasets are backed by the memory-mapped token ids, and batches are built from them.
+    load_splits must return a list of preprocessed datasets (or None). With grow_vocab, the words of the examples are
+    added to the vocabulary before they are numericalized (on a hit, the words added when the cache was saved).
+
+    Only the NumericalizedExamples.cache_size most recently used caches of each task are kept.
+    Returns the list of datasets and the list of words added to the vocabulary.
+    """
+    if not hasattr(numericalizer, 'set_token_ids'):
+        if logger is not None:
+            logger.info('Numericalized cache is not supported with this numericalizer, skipping')
+        datasets = load_splits()
+        new_words = []
+        if grow_vocab:
+            for dataset in datasets:
+                if dataset is not None:
+                    new_words += numericalizer.grow_vocab(dataset)
+        return datasets, new_words
+
+    split_kwargs = {name: value for name, value in split_kwargs.items()
+                    if name not in ('skip_cache', 'cache_input_data', 'cached_path')}
+    cache_key = NumericalizedExamples.cache_key(numericalizer, args.data, exclude_dirs=[args.cache],
+                                                task=task_options(task), split_kwargs=sorted(split_kwargs.items()),
+                                                lower=args.lower, train=train, grow_vocab=grow_vocab,
+                                                max_context_length=args.max_train_context_length if train
+                                                else args.max_val_context_length,
+                                                max_answer_length=args.max_answer_length if train else None)
+    cache_name = os.path.join(args.cache, task.name, 'numericalized', cache_key)
+    if os.path.exists(cache_name) and not args.skip_cache:
+        if logger is not None:
+            logger.info(f'Loading numericalized {task.name} examples from {cache_name}')
+        numericalized, metadata = NumericalizedExamples.load_cache(cache_name, mmap_mode='r')
+        new_words = numericalizer.add_words(metadata['new_words']) if grow_vocab else []
+        datasets = [None if numericalized_examples is None else
+                    CQA(numericalized_examples.as_examples(numericalizer), **dataset_args)
+                    for numericalized_examples, dataset_args in zip(numericalized, metadata['datasets'])]
+    else:
+        datasets = load_splits()
+        new_words = []
+        if grow_vocab:
+            for dataset in datasets:
+                if dataset is not None:
+                    new_words += numericalizer.grow_vocab(dataset)
+        if logger is not None:
+            logger.info(f'Numericalizing {task.name} examples into {cache_name}')
+        numericalized = [None if dataset is None else NumericalizedExamples.build(dataset.examples, numericalizer)
+                         for dataset in datasets]
+        metadata = {'new_words': new_words,
+                    'datasets': [None if dataset is None else
+                                 {'sort_key_fn': dataset.sort_key_fn, 'batch_size_fn': dataset.batch_size_fn,
+                                  'groups': dataset.groups} for dataset in datasets]}
+        NumericalizedExamples.save_cache(cache_name, numericalized, metadata)
+
+        # use the memory-mapped ids from now on, so the words of the examples can be freed
+        numericalized, _ = NumericalizedExamples.load_cache(cache_name, mmap_mode='r')
+        for dataset, numericalized_examples in zip(datasets, numericalized):
+            if dataset is not None:
+                dataset.examples = numericalized_examples.as_examples(numericalizer)
+
+    # mark the cache as recently used, then remove the least recently used ones
+    os.utime(cache_name)
+    NumericalizedExamples.prune(os.path.dirname(cache_name), NumericalizedExamples.cache_size)
+    return datasets, new_words
+
+
 def init_devices(args, devices=None):
     if not torch.cuda.is_available():
         return [torch.device('cpu')]
@@ -28,6 +28,52 @@ TMPDIR=`pwd`
 workdir=`mktemp -d $TMPDIR/genieNLP-tests-XXXXXX`
 trap on_error ERR INT TERM
 
+# check the batched encoding of the simple numericalizer against a token by token encoding
+pipenv run python3 - <<'EOF'
+import random
+from collections import namedtuple
+from genienlp.data_utils.example import TokenList
+from genienlp.data_utils.numericalizer.simple import SimpleNumericalizer
+
+Ex = namedtuple('Ex', ['context', 'question', 'answer'])
+random.seed(0)
+words = ['w%d' % i for i in range(60)]
+examples = [Ex(*[TokenList(random.choices(words[:40], k=random.randint(0, 9))) for _ in range(3)]) for _ in range(30)]
+pool = [TokenList(random.choices(words, k=random.randint(0, 9))) for _ in range(30)]
+
+def reference(numericalizer, rows, decoder_vocab):
+    lengths = [len(row) for row, _pad_count in rows]
+    rows = [[numericalizer.pad_token] * pad_count + row if numericalizer.pad_first else row + [numericalizer.pad_token] * pad_count
+            for row, pad_count in rows]
+    return (lengths, [[numericalizer.vocab.stoi[word] for word in row] for row in rows],
+            [[decoder_vocab.encode(word) for word in row] for row in rows])
+
+for pad_first in (False, True):
+    for max_generative_vocab in (20, 100):
+        # the vocabulary does not include the separator, so it is encoded as an out-of-vocabulary word
+        numericalizer = SimpleNumericalizer(max_generative_vocab, pad_first=pad_first)
+        numericalizer.build_vocab(['context', 'question', 'answer'], [examples])
+        for _ in range(50):
+            decoder_vocab = numericalizer.decoder_vocab.clone()
+            expected_vocab = numericalizer.decoder_vocab.clone()
+            pairs = [((random.choice(pool), None), (random.choice(pool), None)) for _ in range(random.randint(1, 5))]
+            max_len = max(len(a) + len(b) for (a, _), (b, _) in pairs)
+            rows = [([numericalizer.init_token] + list(a) + [numericalizer.sep_token] + list(b) + [numericalizer.eos_token],
+                     2 * max_len - len(a) - len(b)) for (a, _), (b, _) in pairs]
+            encoded = numericalizer.encode_pair(pairs, decoder_vocab)
+            assert (encoded.length.tolist(), encoded.value.tolist(), encoded.limited.tolist()) == \
+                reference(numericalizer, rows, expected_vocab)
+            assert decoder_vocab.oov_itos == expected_vocab.oov_itos
+
+            minibatch = [(random.choice(pool), None) for _ in range(random.randint(1, 5))]
+            max_len = max(len(tokens) for tokens, _ in minibatch)
+            rows = [([numericalizer.init_token] + list(tokens) + [numericalizer.eos_token], max_len - len(tokens))
+                    for tokens, _ in minibatch]
+            encoded = numericalizer.encode_single(minibatch, decoder_vocab)
+            assert (encoded.length.tolist(), encoded.value.tolist(), encoded.limited.tolist()) == \
+                reference(numericalizer, rows, expected_vocab)
+EOF
+
 
 i=0
 for hparams in \
@@ -55,6 +101,209 @@ do
     if [ $i == 0 ] ; then
       echo "Testing the server mode"
       echo '{"id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk", "answer": "now => () => notify"}' | pipenv run python3 -m genienlp server --path $workdir/model_$i --stdin
+
+      # bad requests are answered with an error, and do not prevent answering the other requests of the batch
+      printf '%s\n' \
+        '{"id": "stdin_1", "context": "show me .", "question": "translate to thingtalk"}' \
+        'not json' \
+        '{"id": "stdin_2", "question": "translate to thingtalk"}' \
+        '{"id": "stdin_3", "context": "show me the weather .", "question": "translate to thingtalk"}' \
+        | pipenv run python3 -m genienlp server --path $workdir/model_$i --stdin --max_batch_wait 1 > $workdir/stdin_responses.jsonl
+      pipenv run python3 - $workdir/stdin_responses.jsonl <<'EOF'
+import json
+import sys
+responses = [json.loads(line) for line in open(sys.argv[1])]
+assert [response['id'] for response in responses] == ['stdin_1', None, 'stdin_2', 'stdin_3'], responses
+assert [('answer' in response) for response in responses] == [True, False, False, True], responses
+assert responses[1]['error'] == 'failed' and responses[2]['error'] == 'failed', responses
+EOF
+
+      echo "Testing the TCP server"
+      printf '%s\n' \
+        '{"id": "tcp_1", "context": "show me .", "question": "translate to thingtalk"}' \
+        '{"id": "tcp_2", "context": "show me the weather .", "question": "translate to thingtalk"}' \
+        '{"id": "tcp_3", "context": "show me my emails .", "question": "translate to thingtalk"}' \
+        '{"id": "tcp_4", "context": "post on twitter .", "question": "translate to thingtalk"}' \
+        > $workdir/tcp_requests.jsonl
+      # in stdin mode, all the requests are answered in one batch, like the concurrent requests to the TCP server
+      pipenv run python3 -m genienlp server --path $workdir/model_$i --embeddings $embedding_dir --stdin --max_batch_wait 1 \
+        < $workdir/tcp_requests.jsonl > $workdir/tcp_expected.jsonl
+      pipenv run python3 - $workdir/model_$i $embedding_dir $workdir/tcp_requests.jsonl $workdir/tcp_responses.jsonl <<'EOF'
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+model, embeddings, requests_file, responses_file = sys.argv[1:]
+requests = [json.loads(line) for line in open(requests_file)]
+
+
+class Client:
+    def __init__(self, port):
+        self.file = socket.create_connection(('localhost', port)).makefile('rw')
+
+    def send(self, request):
+        self.file.write((request if isinstance(request, str) else json.dumps(request)) + '\n')
+        self.file.flush()
+
+    def receive(self):
+        line = self.file.readline()
+        assert line, 'the server closed the connection'
+        return json.loads(line)
+
+    def ask(self, request):
+        self.send(request)
+        return self.receive()
+
+    def stats(self):
+        return self.ask({'id': 'stats', 'command': 'stats'})['stats']
+
+
+def start_server(*args):
+    with socket.socket() as sock:
+        sock.bind(('', 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen([sys.executable, '-m', 'genienlp', 'server', '--path', model, '--embeddings', embeddings,
+                               '--port', str(port), '--stats_interval', '0'] + list(args))
+    deadline = time.time() + 600
+    while True:
+        assert server.poll() is None, 'the server exited'
+        try:
+            return server, port, Client(port)
+        except ConnectionRefusedError:
+            assert time.time() < deadline, 'the server did not start'
+            time.sleep(1)
+
+
+def ask_concurrently(port, requests):
+    clients = [Client(port) for _ in requests]
+    responses = [None] * len(requests)
+
+    def ask(i):
+        responses[i] = clients[i].ask(requests[i])
+    threads = [threading.Thread(target=ask, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
+def stop_server(server, signum):
+    server.send_signal(signum)
+    assert server.wait(timeout=600) == 0
+
+
+def workers(server):
+    pids = set()
+    for name in os.listdir('/proc'):
+        try:
+            with open(f'/proc/{name}/stat') as fp:
+                # the fields after the command name, which is in parentheses, start with the state and the parent pid
+                if int(fp.read().rsplit(')', 1)[1].split()[1]) == server.pid:
+                    pids.add(int(name))
+        except (ValueError, OSError):
+            pass
+    return pids
+
+
+def wait_for_workers(server, ready):
+    deadline = time.time() + 600
+    while not ready(workers(server)):
+        assert time.time() < deadline, workers(server)
+        time.sleep(1)
+    return workers(server)
+
+
+# concurrent requests are batched together, and repeated requests are answered from the response cache
+server, port, client = start_server('--max_batch_wait', '1')
+responses = ask_concurrently(port, requests)
+with open(responses_file, 'w') as fp:
+    for response in responses:
+        fp.write(json.dumps(response) + '\n')
+stats = client.stats()
+assert stats['counters']['requests'] == len(requests) and stats['counters']['batches'] < len(requests), stats
+assert ask_concurrently(port, requests) == responses
+stats = client.stats()
+assert stats['response_cache']['hits'] == len(requests) and stats['counters']['batches'] < len(requests), stats
+
+# bad requests are answered with an error, and the connection stays usable
+assert client.ask('not json')['error'] == 'failed'
+assert client.ask({'id': 'bad_1', 'question': 'translate to thingtalk'})['error'] == 'failed'
+assert client.ask({'id': 'bad_2', 'command': 'nope'})['error'] == 'Invalid command nope'
+assert client.ask({'id': 'bad_3', 'context': 'show me the news .', 'question': 'translate to thingtalk',
+                   'timeout': 'soon'})['error'] == 'invalid'
+assert client.ask(requests[0]) == responses[0]
+
+# a request that cannot be answered before its deadline gets a timeout error
+assert client.ask({'id': 'late', 'context': 'show me the news .', 'question': 'translate to thingtalk',
+                   'timeout': 0.001})['error'] == 'timeout'
+stats = client.stats()
+assert stats['counters']['failed'] == 2 and stats['counters']['timed_out'] == 1, stats
+stop_server(server, signal.SIGINT)
+
+# requests over the in-flight limit are rejected while the first one waits for its batch
+server, port, client = start_server('--max_batch_wait', '1', '--max_in_flight', '1', '--cache_size', '0')
+client.send(requests[0])
+time.sleep(0.2)
+assert Client(port).ask(requests[1])['error'] == 'overloaded'
+assert client.receive() == responses[0]
+assert client.stats()['counters']['rejected'] == 1
+stop_server(server, signal.SIGINT)
+
+# prefork workers answer concurrent requests, are replaced when they die, and hand their connections over to the
+# new workers when the model is reloaded
+server, port, _ = start_server('--num_workers', '2', '--cache_size', '0')
+assert [response['id'] for response in ask_concurrently(port, requests)] == [request['id'] for request in requests]
+old_workers = wait_for_workers(server, lambda pids: len(pids) == 2)
+os.kill(next(iter(old_workers)), signal.SIGKILL)
+old_workers = wait_for_workers(server, lambda pids: len(pids) == 2 and pids != old_workers)
+client = Client(port)
+assert 'answer' in client.ask(requests[1])
+server.send_signal(signal.SIGHUP)
+wait_for_workers(server, lambda pids: len(pids) == 2 and not (pids & old_workers))
+assert 'answer' in client.ask(requests[2])
+assert [response['id'] for response in ask_concurrently(port, requests)] == [request['id'] for request in requests]
+stop_server(server, signal.SIGTERM)
+EOF
+      diff -u $workdir/tcp_expected.jsonl $workdir/tcp_responses.jsonl
+
+      echo "Testing the numericalized cache"
+      # the first run saves the cache, the second one loads it instead of the dataset
+      for run in 1 2 ; do
+        pipenv run python3 -c "import logging ; logging.basicConfig(level=logging.INFO) ; from genienlp.__main__ import main ; main()" predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results_cache/ --data $SRCDIR/dataset/ --embeddings $embedding_dir --cache $workdir/cache --numericalized_cache 2> $workdir/numericalized_$run.log
+      done
+      grep -q "Loading numericalized almond examples" $workdir/numericalized_2.log
+      if test ! -d $workdir/cache/almond/numericalized ; then
+        echo "Numericalized cache not found!"
+        exit 1
+      fi
+      diff -u $workdir/model_$i/eval_results/test/almond.tsv $workdir/model_$i/eval_results_cache/test/almond.tsv
+
+      echo "Testing the export of vocabulary embeddings"
+      # export quantized vectors, then load them without the full embedding tables, with a different --vectors_dtype
+      pipenv run python3 -m genienlp export --path $workdir/model_$i --output $workdir/model_${i}_exported --embeddings $embedding_dir --vocab_embeddings --vectors_dtype float16
+      mkdir -p $workdir/no_embeddings
+      pipenv run python3 -m genienlp predict --tasks almond --evaluate test --path $workdir/model_${i}_exported --overwrite --eval_dir $workdir/model_${i}_exported/eval_results/ --data $SRCDIR/dataset/ --embeddings $workdir/no_embeddings --skip_cache --no_vocab_embeddings_fallback
+      if test ! -f $workdir/model_${i}_exported/eval_results/test/almond.tsv ; then
+        echo "File not found!"
+        exit 1
+      fi
+      echo '{"id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk", "answer": "now => () => notify"}' | pipenv run python3 -m genienlp server --path $workdir/model_${i}_exported --embeddings $workdir/no_embeddings --no_vocab_embeddings_fallback --vectors_dtype int8 --stdin
+
+      echo "Testing quantized word vectors"
+      cp -r $embedding_dir $workdir/embeddings_int8
+      pipenv run python3 -m genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results_int8/ --data $SRCDIR/dataset/ --embeddings $workdir/embeddings_int8 --skip_cache --vectors_dtype int8
+      if test ! -f $workdir/model_$i/eval_results_int8/test/almond.tsv ; then
+        echo "File not found!"
+        exit 1
+      fi
+
+      rm -rf $workdir/model_${i}_exported $workdir/no_embeddings $workdir/embeddings_int8 $workdir/cache
     fi
 
     rm -rf $workdir/model_$i